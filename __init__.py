@@ -9,8 +9,10 @@
 '''
 from trytond.pool import Pool
 
-from sale import Sale, SaleLine
-from payment import Website, NereidPaymentMethod
+from sale import Sale, SaleLine, SalePayment, SaleComment, \
+    SaleCommentEvent, SaleOrderCount
+from payment import Website, NereidPaymentMethod, PaymentMethodRule, \
+    PaymentProfile
 from checkout import Cart, Checkout, Party, Address
 from configuration import Configuration
 
@@ -24,7 +26,13 @@ def register():
         Website,
         Checkout,
         NereidPaymentMethod,
+        PaymentMethodRule,
         Address,
         SaleLine,
+        SalePayment,
+        SaleComment,
+        SaleCommentEvent,
+        SaleOrderCount,
+        PaymentProfile,
         type_="model", module="nereid_checkout"
     )
@@ -12,7 +12,7 @@ from datetime import datetime
 from functools import wraps
 
 from nereid import render_template, request, url_for, flash, redirect, \
-    current_app, current_user, route, login_required
+    current_app, current_user, route, login_required, jsonify
 from nereid.signals import failed_login
 from nereid.globals import session
 from flask.ext.login import login_user
@@ -25,7 +25,10 @@ from werkzeug.wrappers import BaseResponse
 from trytond.model import ModelView, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
 from trytond.pyson import Eval
+from trytond import backend
+from sql.functions import CurrentTimestamp
 
 from .i18n import _
 
@@ -43,10 +46,21 @@ class Cart:
         The default implementation returns all the possible payment methods
         that exist in the website.
 
+        The methods are filtered by the eligibility rules defined on them
+        (amount range, country, currency and customer type).
+
         Downstream modules can additional filters to decide which payment
         methods are available. For example, to limit COD below certain amount.
         """
-        return self.website.alternate_payment_methods
+        PaymentMethod = Pool().get('nereid.website.payment_method')
+
+        if not self.sale:
+            return self.website.alternate_payment_methods
+
+        return PaymentMethod.filter_eligible(
+            self.website.alternate_payment_methods, self.sale,
+            'guest' if current_user.is_anonymous() else 'registered'
+        )
 
     def _clear_cart(self):
         """
@@ -61,6 +75,56 @@ class Cart:
 
         super(Cart, self)._clear_cart()
 
+    def _claim_sale(self, sale):
+        """
+        Lock the cart for the checkout of the current transaction, if it
+        still points to the sale. Return True if the cart was locked and
+        False if another submission of the checkout already detached the
+        sale from it.
+
+        The cart row stays locked till the end of the transaction, so
+        through the authorization of the payment too. A concurrent
+        submission waits for this transaction and, since Tryton runs
+        transactions at the REPEATABLE READ isolation level, fails with a
+        `DatabaseOperationalError` once it commits. The error is taken for
+        a lost claim only if the cart is found without the sale after it;
+        any other failure (a deadlock or a lock timeout for example) is
+        raised again, so that the request is retried.
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        transaction = Transaction()
+        cursor = transaction.cursor
+        cart = self.__table__()
+
+        try:
+            cursor.execute(*cart.update(
+                columns=[cart.write_uid, cart.write_date],
+                values=[transaction.user, CurrentTimestamp()],
+                where=(cart.id == self.id) & (cart.sale == sale.id)
+            ))
+        except DatabaseOperationalError:
+            if self._is_sale_detached(sale):
+                return False
+            raise
+        return cursor.rowcount == 1
+
+    def _is_sale_detached(self, sale):
+        """
+        Return True if the cart no longer points to the sale, as committed
+        by now. The cart is read in a transaction of its own, since the
+        current one may have failed.
+        """
+        with Transaction().new_cursor() as transaction:
+            cursor = transaction.cursor
+            cart = self.__table__()
+            cursor.execute(*cart.select(
+                cart.sale, where=cart.id == self.id
+            ))
+            row = cursor.fetchone()
+            cursor.rollback()
+        return row is None or row[0] != sale.id
+
 
 def not_empty_cart(function):
     """
@@ -128,11 +192,64 @@ class Party:
         '''
         PaymentProfile = Pool().get('party.payment_profile')
 
-        return PaymentProfile.search([
-            ('party', '=', self.id),
-            ('gateway.method', '=', method),
+        return PaymentProfile.browse([
+            summary['id'] for summary in
+            self.get_payment_profile_summaries(method)
         ])
 
+    def get_payment_profile_summaries(self, method='credit_card'):
+        '''
+        Return the cached summaries (id, rec_name, method, address and
+        expiry) of the payment profiles of the type
+        '''
+        PaymentProfile = Pool().get('party.payment_profile')
+
+        return PaymentProfile.get_summaries(self.id, method)
+
+
+#: Cache of the static choices used by the checkout forms. The entries are
+#: keyed by (name, year, language) and the whole cache is dropped when the
+#: year rolls over. See :func:`get_form_choices`.
+_form_choices_cache = {'year': None, 'choices': {}}
+
+
+def get_form_choices(name, builder):
+    """
+    Return the choices identified by `name` for the current year and
+    language, building them with `builder` only if they are not cached yet.
+
+    The choices are resolved to plain unicode strings so that the lazy
+    translations are evaluated once per language instead of once per form
+    instance.
+
+    :param name: A unique name for the set of choices
+    :param builder: A callable which accepts the current year and returns
+                    a list of (value, label) tuples
+    """
+    year = datetime.utcnow().date().year
+    if _form_choices_cache['year'] != year:
+        # New year, the expiry year ranges are stale
+        _form_choices_cache['choices'] = {}
+        _form_choices_cache['year'] = year
+
+    key = (name, year, Transaction().language)
+    choices = _form_choices_cache['choices'].get(key)
+    if choices is None:
+        choices = [
+            (value, unicode(label)) for value, label in builder(year)
+        ]
+        _form_choices_cache['choices'][key] = choices
+    return choices
+
+
+def expiry_year_range(year=None):
+    """
+    Return the (start, end) range of years accepted as card expiry years
+    """
+    if year is None:
+        year = datetime.utcnow().date().year
+    return (year, year + 25)
+
 
 class CreditCardForm(Form):
     owner = TextField('Full Name on Card', [validators.DataRequired(), ])
@@ -157,13 +274,8 @@ class CreditCardForm(Form):
             ('12', _('12-December')),
         ]
     )
-
-    current_year = datetime.utcnow().date().year
-    year_range = (current_year, current_year + 25)
     expiry_year = SelectField(
-        'Card Expiry Year',
-        [validators.DataRequired(), validators.NumberRange(*year_range)],
-        coerce=int,
+        'Card Expiry Year', [validators.DataRequired()], coerce=int,
     )
     cvv = TextField(
         'CVD/CVV Number',
@@ -174,10 +286,23 @@ class CreditCardForm(Form):
     def __init__(self, *args, **kwargs):
         super(CreditCardForm, self).__init__(*args, **kwargs)
 
-        # Set the expiry year values
-        self.expiry_year.choices = [
-            (year, year) for year in range(*self.year_range)
-        ]
+        self.expiry_month.choices = get_form_choices(
+            'credit_card.expiry_month',
+            lambda year: self.expiry_month.choices
+        )
+        self.expiry_year.choices = get_form_choices(
+            'credit_card.expiry_year',
+            lambda year: [
+                (y, y) for y in range(*expiry_year_range(year))
+            ]
+        )
+
+    @property
+    def year_range(self):
+        return expiry_year_range()
+
+    def validate_expiry_year(self, field):
+        validators.NumberRange(*self.year_range)(self, field)
 
 
 class PaymentForm(Form):
@@ -210,6 +335,14 @@ class CheckoutSignInForm(Form):
     )
     remember = BooleanField(_('Remember Me'))
 
+    def __init__(self, *args, **kwargs):
+        super(CheckoutSignInForm, self).__init__(*args, **kwargs)
+
+        self.checkout_mode.choices = get_form_choices(
+            'checkout_sign_in.checkout_mode',
+            lambda year: self.checkout_mode.choices
+        )
+
     def validate_password(self, field):
         if self.checkout_mode.data == 'account' and not field.data:
             raise ValidationError(_('Password is required.'))
@@ -666,8 +799,8 @@ class Checkout(ModelView):
         # add profiles of the registered user
         if not current_user.is_anonymous():
             payment_form.payment_profile.choices = [
-                (p.id, p.rec_name) for p in
-                current_user.party.get_payment_profiles()
+                (p['id'], p['rec_name']) for p in
+                current_user.party.get_payment_profile_summaries()
             ]
 
         if (cart.sale.shipment_address == cart.sale.invoice_address) or (
@@ -689,22 +822,31 @@ class Checkout(ModelView):
         cart = NereidCart.open_cart()
         payment_form = cls.get_payment_form()
         credit_card_form = cls.get_credit_card_form()
+        pre_authorize = request.nereid_website.pre_authorize_payment_profiles
 
         if not current_user.is_anonymous() and \
                 payment_form.payment_profile.data:
             # Regd. user with payment_profile
-            rv = cart.sale._add_sale_payment(
-                payment_profile=PaymentProfile(
-                    payment_form.payment_profile.data
-                )
+            payment_profile = PaymentProfile(
+                payment_form.payment_profile.data
             )
+            if pre_authorize and \
+                    cart.sale._use_pre_authorization(payment_profile):
+                # Already authorized while the user was on the payment page
+                return cls.confirm_cart(cart)
+
+            rv = cart.sale._add_sale_payment(payment_profile=payment_profile)
             if isinstance(rv, BaseResponse):
                 # Redirects only if payment profile is invalid.
                 # Then do not confirm the order, just redirect
                 return rv
             return cls.confirm_cart(cart)
 
-        elif payment_form.alternate_payment_method.data:
+        if pre_authorize:
+            # The user did not go ahead with the pre-authorized profile
+            cart.sale._void_pre_authorization()
+
+        if payment_form.alternate_payment_method.data:
             # Checkout using alternate payment method
             rv = cart.sale._add_sale_payment(
                 alternate_payment_method=PaymentMethod(
@@ -752,6 +894,16 @@ class Checkout(ModelView):
 
         if request.method == 'POST' and payment_form.validate():
 
+            # Claim the sale before it is written or any payment is added
+            # to it, so that only one submission of the checkout goes ahead
+            order_url = url_for(
+                'sale.sale.render', active_id=cart.sale.id,
+                confirmation=True, access_code=cart.sale.guest_access_code,
+            )
+            if not cart._claim_sale(cart.sale):
+                # Another submission claimed the sale and committed
+                return redirect(order_url)
+
             # Setting sale date as current date
             cart.sale.sale_date = Date.today()
             cart.sale.save()
@@ -779,10 +931,74 @@ class Checkout(ModelView):
             PaymentMethod=PaymentMethod,
         )
 
+    @classmethod
+    @route('/checkout/payment/pre-authorize', methods=['POST'])
+    @login_required
+    @not_empty_cart
+    @sale_has_non_guest_party
+    @with_company_context
+    def pre_authorize_payment(cls):
+        '''
+        Authorize the amount to checkout on the chosen payment profile while
+        the customer is still on the payment page.
+
+        The payment page is expected to POST the `payment_profile` to this
+        handler (asynchronously) as soon as the customer selects a saved
+        card, so that the gateway latency is hidden behind the time taken
+        by the customer to submit the order. The submission of the payment
+        page then only confirms the order, unless the amount to checkout
+        or the chosen profile has changed in the meantime.
+
+        This is available only if the website is configured to
+        pre-authorize payment profiles.
+        '''
+        NereidCart = Pool().get('nereid.cart')
+        PaymentProfile = Pool().get('party.payment_profile')
+
+        if not request.nereid_website.pre_authorize_payment_profiles:
+            abort(404)
+
+        cart = NereidCart.open_cart()
+        payment_form = cls.get_payment_form()
+
+        if not (payment_form.validate() and payment_form.payment_profile.data):
+            return jsonify(
+                success=False, errors=payment_form.errors
+            ), 400
+
+        payment_profile = PaymentProfile(payment_form.payment_profile.data)
+        if payment_profile.party != current_user.party:
+            abort(403)
+
+        if not cart.sale._use_pre_authorization(payment_profile):
+            try:
+                cart.sale.pre_authorize_payment_profile(payment_profile)
+            except UserError, e:
+                # The order is paid as usual on submission
+                cart.sale._void_pre_authorization()
+                return jsonify(success=False, message=e.message), 402
+
+            if not cart.sale._use_pre_authorization(payment_profile):
+                # The gateway did not authorize the amount, the payment is
+                # voided and the order is paid as usual on submission
+                return jsonify(
+                    success=False,
+                    message=unicode(_('The payment could not be authorized')),
+                ), 402
+
+        return jsonify(
+            success=True,
+            amount=unicode(cart.sale._get_pre_authorized_payment().amount),
+        )
+
     @classmethod
     def confirm_cart(cls, cart):
         '''
         Confirm the sale, clear the sale from the cart
+
+        The payment page claims the sale (see :py:meth:`Cart._claim_sale`)
+        before it gets here, so when the checkout is submitted twice only
+        one submission confirms the order.
         '''
         Sale = Pool().get('sale.sale')
 
@@ -819,6 +1035,29 @@ class Address:
         ], depends=['party'], select=True
     )
 
+    @classmethod
+    def write(cls, *args):
+        "Refresh the search text of the orders of the modified addresses"
+        Sale = Pool().get('sale.sale')
+
+        super(Address, cls).write(*args)
+
+        actions = iter(args)
+        address_ids = set()
+        for addresses, values in zip(actions, actions):
+            if set(values) & set(['name', 'city']):
+                address_ids.update(map(int, addresses))
+        if address_ids:
+            sales = Sale.search([
+                ('search_text', '!=', None),
+                ['OR', [
+                    ('shipment_address', 'in', list(address_ids)),
+                ], [
+                    ('invoice_address', 'in', list(address_ids)),
+                ]],
+            ])
+            Sale._refresh_search_text(map(int, sales))
+
     @classmethod
     @route("/create-address", methods=["GET", "POST"])
     @login_required
@@ -6,6 +6,7 @@
     :license: GPLv3, see LICENSE for more details.
 """
 
+from trytond.model import fields
 from trytond.pool import PoolMeta
 
 __all__ = ['Configuration']
@@ -18,6 +19,17 @@ class Configuration:
     """
     __name__ = 'sale.configuration'
 
+    #: If more than one, references of sales are reserved from the sale
+    #: sequence in blocks of this size by each worker process, so that
+    #: concurrent checkouts do not wait on each other to lock the
+    #: sequence. References reserved but not used (for example when the
+    #: process exits) are lost, so this is also the tolerated gap.
+    sale_reference_block_size = fields.Integer(
+        'Sale Reference Block Size',
+        help='Number of sale references reserved at a time by each process. '
+        'Unused references leave gaps in the sequence.'
+    )
+
     @staticmethod
     def default_payment_authorize_on():
         return 'manual'
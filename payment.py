@@ -9,8 +9,14 @@
 """
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import PoolMeta, Pool
+from trytond.cache import Cache
+from trytond.transaction import Transaction
+from trytond.pyson import Eval
+from trytond import backend
 
-__all__ = ['Website', 'NereidPaymentMethod']
+__all__ = [
+    'Website', 'NereidPaymentMethod', 'PaymentMethodRule', 'PaymentProfile'
+]
 __metaclass__ = PoolMeta
 
 
@@ -23,6 +29,13 @@ class Website:
         'Alternate Payment Methods'
     )
 
+    #: If set, the payment page may authorize the amount to checkout on a
+    #: saved payment profile as soon as the customer selects it. See
+    #: :py:meth:`nereid.checkout.pre_authorize_payment`
+    pre_authorize_payment_profiles = fields.Boolean(
+        'Pre-authorize Payment Profiles'
+    )
+
 
 class NereidPaymentMethod(ModelSQL, ModelView):
     "Alternate payment gateway mechanisms"
@@ -43,6 +56,10 @@ class NereidPaymentMethod(ModelSQL, ModelView):
     instructions = fields.Text('Instructions')
     sequence = fields.Integer('Sequence', required=True, select=True)
     website = fields.Many2One('nereid.website', 'Website', required=True)
+    rules = fields.One2Many(
+        'nereid.website.payment_method.rule', 'payment_method',
+        'Eligibility Rules'
+    )
 
     @staticmethod
     def default_sequence():
@@ -82,3 +99,184 @@ class NereidPaymentMethod(ModelSQL, ModelView):
             return PaymentTransaction.process([transaction])
 
         raise Exception('Not Implemented %s' % self.method)
+
+    @classmethod
+    def filter_eligible(cls, methods, sale, customer_type):
+        """
+        Return the payment methods whose eligibility rules match the sale.
+
+        A method without rules is always eligible. A method with rules is
+        eligible if any one of its rules matches.
+
+        :param methods: List of active records of payment methods
+        :param sale: Active record of the sale being checked out
+        :param customer_type: `guest` or `registered`
+        """
+        Rule = Pool().get('nereid.website.payment_method.rule')
+
+        index = Rule.get_index()
+        address = sale.shipment_address or sale.invoice_address
+        facts = (
+            sale.total_amount,
+            address and address.country and address.country.id,
+            sale.currency.id,
+            customer_type,
+        )
+        return [
+            method for method in methods
+            if method.id not in index or
+            any(Rule.match(rule, *facts) for rule in index[method.id])
+        ]
+
+
+class PaymentMethodRule(ModelSQL, ModelView):
+    "Eligibility rule of an alternate payment method"
+    __name__ = 'nereid.website.payment_method.rule'
+
+    payment_method = fields.Many2One(
+        'nereid.website.payment_method', 'Payment Method',
+        required=True, select=True, ondelete='CASCADE'
+    )
+    min_amount = fields.Numeric('Minimum Amount', digits=(16, 4))
+    max_amount = fields.Numeric('Maximum Amount', digits=(16, 4))
+    country = fields.Many2One('country.country', 'Country')
+    currency = fields.Many2One('currency.currency', 'Currency')
+    customer_type = fields.Selection([
+        ('any', 'Any'),
+        ('guest', 'Guest'),
+        ('registered', 'Registered'),
+    ], 'Customer Type', required=True)
+
+    _index_cache = Cache(
+        'nereid.website.payment_method.rule.get_index', context=False
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentMethodRule, cls).__setup__()
+        cls.max_amount.domain = [
+            'OR',
+            ('max_amount', '=', None),
+            ('min_amount', '=', None),
+            ('max_amount', '>=', Eval('min_amount')),
+        ]
+        cls.max_amount.depends = ['min_amount']
+
+    @staticmethod
+    def default_customer_type():
+        return 'any'
+
+    @classmethod
+    def get_index(cls):
+        """
+        Return a dictionary mapping the id of each payment method which has
+        rules to a list of compiled rules. A compiled rule is a tuple of
+        (min_amount, max_amount, country, currency, customer_type).
+
+        The index is built once and cached till a rule is changed.
+        """
+        index = cls._index_cache.get(None)
+        if index is None:
+            index = {}
+            for rule in cls.search([]):
+                index.setdefault(rule.payment_method.id, []).append((
+                    rule.min_amount,
+                    rule.max_amount,
+                    rule.country and rule.country.id,
+                    rule.currency and rule.currency.id,
+                    rule.customer_type,
+                ))
+            cls._index_cache.set(None, index)
+        return index
+
+    @staticmethod
+    def match(rule, amount, country, currency, customer_type):
+        """
+        Check if a compiled rule matches the given facts
+        """
+        min_amount, max_amount, rule_country, rule_currency, rule_type = rule
+        return (
+            (min_amount is None or amount >= min_amount) and
+            (max_amount is None or amount <= max_amount) and
+            (rule_country is None or rule_country == country) and
+            (rule_currency is None or rule_currency == currency) and
+            (rule_type == 'any' or rule_type == customer_type)
+        )
+
+    @classmethod
+    def create(cls, vlist):
+        cls._index_cache.clear()
+        return super(PaymentMethodRule, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._index_cache.clear()
+        super(PaymentMethodRule, cls).write(*args)
+
+    @classmethod
+    def delete(cls, rules):
+        cls._index_cache.clear()
+        super(PaymentMethodRule, cls).delete(rules)
+
+
+class PaymentProfile:
+    "Cache the payment profile summaries of a party"
+    __name__ = 'party.payment_profile'
+
+    _summary_cache = Cache(
+        'party.payment_profile.get_summaries', context=False
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(PaymentProfile, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+
+        # The payment page looks up the profiles of a party by gateway
+        table.index_action(['party', 'gateway'], 'add')
+
+    @classmethod
+    def get_summaries(cls, party, method='credit_card'):
+        """
+        Return a list of dictionaries summarising the payment profiles of
+        the party which use a gateway of the given method.
+
+        The summaries of all the profiles of a party are cached and the
+        cache is invalidated whenever a profile is created, modified or
+        deleted.
+
+        :param party: ID of the party
+        :param method: The method of the payment gateway
+        """
+        summaries = cls._summary_cache.get(party)
+        if summaries is None:
+            summaries = [{
+                'id': profile.id,
+                'rec_name': profile.rec_name,
+                'method': profile.gateway.method,
+                'address': profile.address and profile.address.id,
+                'expiry_month': profile.expiry_month,
+                'expiry_year': profile.expiry_year,
+            } for profile in cls.search([('party', '=', party)])]
+            cls._summary_cache.set(party, summaries)
+
+        return [s for s in summaries if s['method'] == method]
+
+    @classmethod
+    def create(cls, vlist):
+        cls._summary_cache.clear()
+        return super(PaymentProfile, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._summary_cache.clear()
+        super(PaymentProfile, cls).write(*args)
+
+    @classmethod
+    def delete(cls, profiles):
+        cls._summary_cache.clear()
+        super(PaymentProfile, cls).delete(profiles)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+    resend_emails
+
+    Re-send the confirmation emails of sales in bulk::
+
+        python -m trytond.modules.nereid_checkout.resend_emails \
+            myproject.application:app "[('state', '=', 'confirmed')]"
+
+    The first argument is the import path of the (initialised) nereid
+    application whose templates render the emails.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import sys
+import argparse
+from ast import literal_eval
+from importlib import import_module
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+def load_app(path):
+    """
+    Return the application from an import path like `module:attribute`
+    """
+    module_name, attribute = path.split(':')
+    return getattr(import_module(module_name), attribute)
+
+
+def report(done, total, queued, elapsed):
+    """
+    Print the progress of the emails queued
+    """
+    sys.stdout.write(
+        '%d/%d sales, %d emails queued, %.1f sales/s\n' % (
+            done, total, queued, done / elapsed if elapsed else 0
+        )
+    )
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Re-send the confirmation emails of sales'
+    )
+    parser.add_argument(
+        'app', help='Import path of the nereid application (module:app)'
+    )
+    parser.add_argument(
+        'domain', type=literal_eval,
+        help='Domain of the sales, like "[(\'state\', \'=\', \'done\')]"'
+    )
+    parser.add_argument(
+        '--chunk-size', type=int, default=100,
+        help='Number of sales rendered at a time'
+    )
+    args = parser.parse_args(argv)
+
+    app = load_app(args.app)
+
+    with app.test_request_context('/'):
+        with Transaction().start(app.config['DATABASE_NAME'], 0):
+            Sale = Pool().get('sale.sale')
+            queued = Sale.resend_confirmation_emails(
+                args.domain, chunk_size=args.chunk_size, progress=report
+            )
+            Transaction().cursor.commit()
+
+    sys.stdout.write('%d emails queued\n' % queued)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,27 +7,304 @@
     :copyright: (c) 2011-2015 by Openlabs Technologies & Consulting (P) Limited
     :license: GPLv3, see LICENSE for more details.
 """
+import csv
 import json
+import time
+import logging
+from hashlib import sha1
+from StringIO import StringIO
 from uuid import uuid4
+from collections import deque, defaultdict
+from threading import Lock
+from weakref import WeakSet
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 
-from trytond.model import fields
+from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import PoolMeta, Pool
 
 from nereid import render_template, request, abort, login_required, \
-    route, current_user, flash, redirect, url_for, jsonify
+    route, current_user, flash, redirect, url_for, jsonify, current_app, \
+    render_email
+from nereid.globals import session
 from nereid.contrib.pagination import Pagination
 from nereid.ctx import has_request_context
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from flask import after_this_request
+from jinja2 import FileSystemBytecodeCache, TemplateNotFound, Markup
+from jinja2.bccache import Bucket
+from sql import Literal, Union, Null
+from sql.aggregate import Count, Max, Sum
+from sql.conditionals import Coalesce
+from sql.functions import Function, CurrentTimestamp
+from sql.operators import BinaryOperator, ILike
 
 from .i18n import _
 
-__all__ = ['Sale', 'SaleLine']
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'Sale', 'SaleLine', 'SalePayment', 'SaleComment', 'SaleCommentEvent',
+    'SaleOrderCount',
+]
 __metaclass__ = PoolMeta
 
 
+#: Helpers available to the email templates. These are shared by all the
+#: emails rendered instead of being built for every email.
+EMAIL_TEMPLATE_HELPERS = {
+    'url_for': url_for,
+    'has_request_context': has_request_context,
+    'to_json': json.dumps,
+}
+
+#: The email templates compiled ahead of the first email rendered. See
+#: :func:`prepare_email_templates`
+EMAIL_TEMPLATES = [
+    'emails/sale-confirmation-text.jinja',
+    'emails/sale-confirmation-html.jinja',
+]
+
+_prepared_environments = WeakSet()
+
+
+class EmailBytecodeCache(FileSystemBytecodeCache):
+    """
+    Bytecode cache in a directory for the email templates alone. The other
+    templates of the environment are compiled as if it had no bytecode
+    cache, so installing it does not change how they are cached.
+    """
+
+    def get_bucket(self, environment, name, filename, source):
+        if name not in EMAIL_TEMPLATES:
+            # A bucket without code, which is never stored
+            return Bucket(environment, None, None)
+        return super(EmailBytecodeCache, self).get_bucket(
+            environment, name, filename, source
+        )
+
+    def set_bucket(self, bucket):
+        if bucket.key is not None:
+            super(EmailBytecodeCache, self).set_bucket(bucket)
+
+
+def prepare_email_templates(env):
+    """
+    Compile the email templates of the sale in the given Jinja environment
+    once, so that the emails rendered later find them in the template cache
+    of the environment.
+
+    If a directory is configured as `email_bytecode_cache` in the
+    `nereid_checkout` section of the trytond configuration, the compiled
+    email templates are also cached there (see
+    :py:class:`EmailBytecodeCache`), so that the worker processes do not
+    parse them again. The environment's own bytecode cache is left
+    untouched if it already has one.
+
+    :param env: The Jinja environment of the application
+    """
+    if env in _prepared_environments:
+        return
+
+    cache_dir = config.get('nereid_checkout', 'email_bytecode_cache')
+    if cache_dir and env.bytecode_cache is None:
+        env.bytecode_cache = EmailBytecodeCache(cache_dir)
+
+    for name in EMAIL_TEMPLATES:
+        try:
+            env.get_template(name)
+        except TemplateNotFound:
+            # Rendering the email would report it
+            pass
+    _prepared_environments.add(env)
+
+
+def get_product_url(uri):
+    """
+    Return the external URL of the product with the given uri
+    """
+    return url_for('product.product.render', uri=uri, _external=True)
+
+
+def escape_like(value):
+    """
+    Escape the wildcards of the value to be matched literally by a LIKE
+    with the backslash as escape character
+    """
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace(
+        '_', '\\_'
+    )
+
+
+def to_datetime(value):
+    """
+    Return the timestamp read by an aggregate query as a datetime. SQLite
+    returns the text of the timestamp as it does not know its type.
+    """
+    if isinstance(value, basestring):
+        value = datetime.strptime(
+            value, '%Y-%m-%d %H:%M:%S.%f' if '.' in value
+            else '%Y-%m-%d %H:%M:%S'
+        )
+    return value
+
+
+class ToTsvector(Function):
+    __slots__ = ()
+    _function = 'TO_TSVECTOR'
+
+
+class PlainToTsquery(Function):
+    __slots__ = ()
+    _function = 'PLAINTO_TSQUERY'
+
+
+class TsMatch(BinaryOperator):
+    __slots__ = ()
+    _operator = '@@'
+
+
+class ReferenceAllocator(object):
+    """
+    Hands out the references of a sequence from blocks of numbers reserved
+    for the current process. A block is reserved in a short transaction of
+    its own, so that the sequence is not locked till the end of the
+    transaction which uses the reference.
+
+    Only the numbers are reserved, the prefix and suffix (which may have
+    the date substituted) are applied when the reference is handed out.
+    The numbers left in a block are dropped when the sequence is modified
+    or the block size changes.
+    """
+
+    #: Number of times the reservation of a block is tried again when it
+    #: conflicts with the reservation of another process
+    retries = 5
+
+    def __init__(self):
+        self._blocks = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def supports(sequence):
+        """
+        Return True if the references of the sequence can be reserved in
+        blocks. Sequences backed by an SQL sequence do not lock a row and
+        are not handled.
+        """
+        return sequence.type == 'incremental' and \
+            not sequence.use_sql_sequence
+
+    def next(self, sequence, block_size):
+        """
+        Return the next reference of the sequence
+
+        :param sequence: An active record of `ir.sequence`
+        :param block_size: Number of references to reserve at a time
+        """
+        Sequence = sequence.__class__
+
+        key = (Transaction().cursor.database_name, sequence.id)
+        version = (block_size, sequence.write_date)
+        with self._lock:
+            block_version, block = self._blocks.get(key, (None, None))
+            if block_version != version or not block:
+                block = deque(self._reserve(sequence, block_size))
+                self._blocks[key] = (version, block)
+            number = block.popleft()
+
+        return '%s%s%s' % (
+            Sequence._process(sequence.prefix),
+            '%%0%sd' % sequence.padding % number,
+            Sequence._process(sequence.suffix),
+        )
+
+    def _reserve(self, sequence, block_size):
+        """
+        Return a list of block_size numbers drawn from the sequence
+        """
+        Sequence = sequence.__class__
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        table = Sequence.__table__()
+
+        def draw(cursor):
+            # The next number is moved past the block without writing the
+            # record, so that its write date only changes with the user's
+            # modifications
+            cursor.execute(*table.update(
+                columns=[table.number_next_internal],
+                values=[
+                    table.number_next_internal +
+                    table.number_increment * block_size
+                ],
+                where=table.id == sequence.id
+            ))
+            cursor.execute(*table.select(
+                table.number_next_internal, table.number_increment,
+                where=table.id == sequence.id
+            ))
+            number_next, increment = cursor.fetchone()
+            first = number_next - increment * block_size
+            return [first + increment * i for i in xrange(block_size)]
+
+        if backend.name() == 'sqlite':
+            # SQLite locks the whole database, a separate transaction has
+            # nothing to gain (and does not see an in-memory database)
+            return draw(Transaction().cursor)
+
+        for attempt in xrange(self.retries + 1):
+            with Transaction().new_cursor() as transaction:
+                try:
+                    numbers = draw(transaction.cursor)
+                except DatabaseOperationalError:
+                    # Another process reserved a block meanwhile
+                    transaction.cursor.rollback()
+                    if attempt == self.retries:
+                        raise
+                    continue
+                except Exception:
+                    transaction.cursor.rollback()
+                    raise
+                transaction.cursor.commit()
+                return numbers
+
+
+reference_allocator = ReferenceAllocator()
+
+
+class KeysetPage(object):
+    """
+    A page of records fetched by keyset (seek) pagination
+
+    :param items: The records of the page
+    :param per_page: Number of records per page
+    :param cursor: The cursor the page starts after
+    :param next_cursor: The cursor of the next page, None if this is the
+                        last page
+    """
+
+    def __init__(self, items, per_page, cursor=None, next_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
 class Sale:
     """Add Render and Render list"""
     __name__ = 'sale.sale'
@@ -37,12 +314,147 @@ class Sale:
     #: as yet
     guest_access_code = fields.Char('Guest Access Code')
 
+    #: Text the orders are searched by in the orders listing. This is
+    #: computed when the sale is confirmed. See :py:meth:`get_search_text`
+    search_text = fields.Text('Search Text', readonly=True)
+
+    #: Compact snapshot of the JSON-LD of the order taken when the sale is
+    #: confirmed. It is cleared if the lines are modified after that. See
+    #: :py:meth:`as_json_ld`
+    json_ld = fields.Text('JSON-LD', readonly=True)
+
+    #: Comments added to the order by the customer. These are stored in a
+    #: model of their own, so that adding a comment never writes (and locks)
+    #: the sale. See :py:meth:`get_comments` for a paginated list.
+    comments = fields.One2Many(
+        'sale.sale.comment', 'sale', 'Comments', readonly=True
+    )
+
     #: Order state in which comments are allowed
     #: See :py:meth:`.add_comment_to_sale` for usage.
     comment_allowed_states = ['confirmed']
 
+    #: Number of comments per page of :py:meth:`get_comments`
+    comments_per_page = 10
+
     per_page = 10
 
+    #: Maximum number of orders which can be fetched by a single request
+    #: to :py:meth:`bulk_fetch`
+    bulk_fetch_limit = 100
+
+    #: The fields available in the summary of an order
+    _summary_fields = {
+        'id': lambda sale: sale.id,
+        'reference': lambda sale: sale.reference,
+        'sale_date': lambda sale: sale.sale_date and
+        sale.sale_date.isoformat(),
+        'state': lambda sale: sale.state,
+        'currency': lambda sale: sale.currency.code,
+        'total_amount': lambda sale: str(sale.total_amount),
+        'payment_total': lambda sale: str(sale.payment_total),
+        'shipment_state': lambda sale: sale.shipment_state,
+        'invoice_state': lambda sale: sale.invoice_state,
+        'lines': lambda sale: len(sale.lines),
+    }
+
+    #: Number of orders read at a time by the export of the order history
+    export_batch_size = 500
+
+    #: Maximum number of seconds a long-poll for the order status is held
+    #: and the interval at which the status is checked meanwhile. See
+    #: :py:meth:`render_status`
+    status_poll_timeout = 10
+    status_poll_interval = 2
+
+    #: Template of the part of the order page which depends on the order
+    #: alone (not on the user or the session). See :py:meth:`render_fragment`
+    fragment_template = 'sale-fragment.jinja'
+
+    #: Cache the rendered order fragments in memory. The cache is keyed by
+    #: the sale, its version and the language, and checked only after the
+    #: user is authorized to see the order. See :py:meth:`render_fragment`.
+    cache_rendered_order = False
+    _render_cache = Cache('sale.sale.render', size_limit=256, context=False)
+
+    #: Receivers of the emails of the sale resolved in bulk, see
+    #: :py:meth:`_get_receiver_email_address`
+    _receiver_email_addresses = None
+
+    @classmethod
+    def __setup__(cls):
+        super(Sale, cls).__setup__()
+        cls._sql_constraints += [
+            ('guest_access_code_uniq', 'UNIQUE(guest_access_code)',
+                'The guest access code of the sale must be unique.'),
+        ]
+        cls._error_messages.update({
+            'invalid_split_amount':
+                'Payment amount "%s" for "%s" must be positive.',
+            'split_exceeds_total':
+                'The payments add up to %s while only %s is to be paid.',
+            'invalid_split_method':
+                'Cannot pay using "%s". Use a payment profile or a payment '
+                'method of the website.',
+            'invalid_split_profile':
+                'The payment profile "%s" does not belong to the customer.',
+            'split_authorization_failed':
+                'The payment using "%s" could not be authorized.',
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        sql_table = cls.__table__()
+
+        # Migration: copies of a sale used to share its guest access code.
+        # Give the copies a code of their own so that the unique constraint
+        # can be installed.
+        if TableHandler.table_exist(cursor, cls._table):
+            table = TableHandler(cursor, cls, module_name)
+            if table.column_exist('guest_access_code'):
+                cursor.execute(*sql_table.select(
+                    sql_table.guest_access_code,
+                    group_by=sql_table.guest_access_code,
+                    having=Count(Literal(1)) > 1
+                ))
+                for access_code, in cursor.fetchall():
+                    if access_code is None:
+                        continue
+                    cursor.execute(*sql_table.select(
+                        sql_table.id,
+                        where=sql_table.guest_access_code == access_code,
+                        order_by=sql_table.id.asc
+                    ))
+                    # The oldest sale keeps the code its links were sent with
+                    for sale_id, in cursor.fetchall()[1:]:
+                        cursor.execute(*sql_table.update(
+                            columns=[sql_table.guest_access_code],
+                            values=[cls.default_guest_access_code()],
+                            where=sql_table.id == sale_id
+                        ))
+
+        super(Sale, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+
+        # Every filter of the orders listing looks up the sales of a party
+        # by state and a range of sale dates
+        table.index_action(['party', 'state', 'sale_date'], 'add')
+
+        if backend.name() == 'postgresql':
+            cursor.execute(
+                "SELECT 1 FROM pg_indexes WHERE indexname = %s",
+                ('sale_sale_search_text_fts_index',)
+            )
+            if not cursor.fetchone():
+                cursor.execute(
+                    'CREATE INDEX "sale_sale_search_text_fts_index" '
+                    'ON "' + cls._table + '" USING gin '
+                    "(TO_TSVECTOR('simple', COALESCE(search_text, '')))"
+                )
+
     @staticmethod
     def default_guest_access_code():
         """A guest access code must be written to the guest_access_code of the
@@ -50,21 +462,78 @@ class Sale:
         """
         return unicode(uuid4())
 
+    @staticmethod
+    def _get_archive_date():
+        """
+        Return the date before which orders are considered archived
+        """
+        return date.today() + relativedelta(months=-3)
+
     @classmethod
-    @route('/orders')
-    @route('/orders/<int:page>')
-    @login_required
-    def render_list(cls, page=1):
-        """Render all orders
+    def get_order_counts(cls, party):
         """
-        filter_by = request.args.get('filter_by', None)
+        Return a dictionary with the number of orders of the party for each
+        filter of the orders listing (`done`, `canceled`, `archived` and
+        `recent`).
+
+        The counts are read from the order counts of the party, which are
+        kept up to date as the sales change (see
+        :py:class:`SaleOrderCount`), with a single indexed query.
+
+        :param party: ID of the party
+        """
+        SaleOrderCount = Pool().get('sale.sale.order_count')
+
+        req_date = cls._get_archive_date()
+        counts = dict.fromkeys(['done', 'canceled', 'archived', 'recent'], 0)
+        for state, is_archived, count in SaleOrderCount.get_counts(
+                party, req_date):
+            if state == 'done':
+                counts['done'] += count
+            elif state == 'cancel':
+                counts['canceled'] += count
+
+            if is_archived is None:
+                # Without a sale date
+                continue
+            if is_archived:
+                counts['archived'] += count
+            elif state != 'cancel':
+                counts['recent'] += count
+        return counts
+
+    @classmethod
+    def copy(cls, sales, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.setdefault('search_text', None)
+        default.setdefault('json_ld', None)
+        default.setdefault('comments', None)
+
+        new_sales = []
+        for sale in sales:
+            # Every sale needs a guest access code of its own
+            default['guest_access_code'] = cls.default_guest_access_code()
+            new_sales.extend(super(Sale, cls).copy([sale], default=default))
+        return new_sales
 
+    @classmethod
+    def _get_orders_domain(cls, filter_by=None, search=None):
+        """
+        Return the domain of the orders of the current user for the given
+        filter (`done`, `canceled`, `archived`, `all` or recent orders by
+        default) and search text
+
+        The `all` filter is the whole order history: every order but the
+        drafts and quotations, whatever their date.
+        """
         domain = [
             ('party', '=', request.nereid_user.party.id),
         ]
-        req_date = (
-            date.today() + relativedelta(months=-3)
-        )
+        if search:
+            domain.extend(cls._get_search_domain(search))
+        req_date = cls._get_archive_date()
 
         if filter_by == 'done':
             domain.append(('state', '=', 'done'))
@@ -72,6 +541,9 @@ class Sale:
         elif filter_by == 'canceled':
             domain.append(('state', '=', 'cancel'))
 
+        elif filter_by == 'all':
+            domain.append(('state', 'not in', ('draft', 'quotation')))
+
         elif filter_by == 'archived':
             domain.append(
                 ('state', 'not in', ('draft', 'quotation'))
@@ -89,11 +561,411 @@ class Sale:
             domain.append((
                 'sale_date', '>=', req_date
             ))
+        return domain
+
+    @classmethod
+    def _get_search_domain(cls, search):
+        """
+        Return the domain of the orders whose search text matches all the
+        words of the search.
+
+        On PostgreSQL the full text index of the search text is used. Other
+        backends fall back to a case insensitive match of each word, with
+        its wildcards escaped.
+        """
+        sale = cls.__table__()
+        if backend.name() == 'postgresql':
+            return [('id', 'in', sale.select(sale.id, where=TsMatch(
+                ToTsvector('simple', Coalesce(sale.search_text, '')),
+                PlainToTsquery('simple', search)
+            )))]
+
+        return [
+            ('id', 'in', sale.select(sale.id, where=ILike(
+                sale.search_text, '%' + escape_like(word) + '%',
+                escape='\\'
+            )))
+            for word in search.split()
+        ]
+
+    def get_search_text(self):
+        """
+        Return the text the order is searched by: the reference, the names
+        and codes of the products and the names and cities of the addresses.
+        """
+        words = [self.reference]
+        for line in self.lines:
+            if line.product:
+                words.extend([line.product.name, line.product.code])
+        for address in set([self.shipment_address, self.invoice_address]):
+            if address:
+                words.extend([address.name, address.city])
+        return u' '.join(filter(None, words))
+
+    @classmethod
+    def update_search_text(cls, sales=None):
+        """
+        Compute and store the search text of the sales, in batches.
+
+        Without sales, the text is computed for the orders which have none
+        though they were confirmed (for example before the search text was
+        stored). A cron runs this to fill them in.
+
+        :param sales: The sales to update
+        """
+        if sales is None:
+            sales = cls.search([
+                ('search_text', '=', None),
+                ('state', 'not in', ['draft', 'quotation']),
+            ], order=[('id', 'ASC')])
+
+        ids = map(int, sales)
+        for index in xrange(0, len(ids), cls.export_batch_size):
+            batch = cls.browse(ids[index:index + cls.export_batch_size])
+            cls._prefetch_for_listing(batch)
+
+            args = []
+            for sale in batch:
+                args.extend([[sale], {'search_text': sale.get_search_text()}])
+            cls.write(*args)
+
+    @classmethod
+    def _refresh_search_text(cls, sale_ids):
+        """
+        Compute again the search text of the sales which have one, after
+        the records it is made of were modified
+        """
+        if not sale_ids:
+            return
+        sales = [
+            sale for sale in cls.browse(list(sale_ids))
+            if sale.search_text is not None
+        ]
+        if sales:
+            cls.update_search_text(sales)
+
+    @staticmethod
+    def _encode_orders_cursor(sale):
+        """
+        Return an opaque cursor pointing to the position of the sale in the
+        keyset ordered by (sale_date, id)
+        """
+        return urlsafe_b64encode(
+            '%s:%d' % (sale.sale_date.isoformat(), sale.id)
+        )
+
+    @staticmethod
+    def _decode_orders_cursor(cursor):
+        """
+        Return the (sale_date, id) tuple encoded in the cursor. Aborts with
+        400 if the cursor is invalid.
+        """
+        try:
+            sale_date, sale_id = urlsafe_b64decode(str(cursor)).split(':')
+            return (
+                datetime.strptime(sale_date, '%Y-%m-%d').date(),
+                int(sale_id)
+            )
+        except (TypeError, ValueError):
+            abort(400)
+
+    @classmethod
+    def _get_keyset_page(cls, domain, cursor=None, per_page=None):
+        """
+        Return a page of sales matching the domain, ordered by the latest
+        sale_date and id, starting after the given cursor.
+
+        Unlike :py:class:`Pagination` this neither counts the records nor
+        uses an offset. One extra record is fetched to know if there is a
+        next page. Sales without a sale date are not listed.
+
+        :param domain: The domain of the sales
+        :param cursor: The cursor returned as `next_cursor` of the previous
+                       page, or None for the first page
+        :param per_page: Number of sales per page
+        """
+        if per_page is None:
+            per_page = cls.per_page
+
+        domain = domain + [('sale_date', '!=', None)]
+        if cursor:
+            sale_date, sale_id = cls._decode_orders_cursor(cursor)
+            domain.append([
+                'OR',
+                ('sale_date', '<', sale_date),
+                [('sale_date', '=', sale_date), ('id', '<', sale_id)],
+            ])
+
+        sales = cls.search(
+            domain, limit=per_page + 1,
+            order=[('sale_date', 'DESC'), ('id', 'DESC')]
+        )
+        return KeysetPage(
+            sales[:per_page], per_page, cursor,
+            cls._encode_orders_cursor(sales[per_page - 1])
+            if len(sales) > per_page else None
+        )
+
+    @classmethod
+    @route('/orders')
+    @route('/orders/<int:page>')
+    @login_required
+    def render_list(cls, page=1):
+        """Render all orders
+
+        The orders can be searched by their reference, products and
+        addresses with the `q` argument. See :py:meth:`_get_search_domain`.
+
+        If a `cursor` is given in the arguments (an empty one for the first
+        page), the orders are paginated by keyset instead of page numbers.
+        See :py:meth:`_get_keyset_page`.
+        """
+        filter_by = request.args.get('filter_by', None)
+
+        domain = cls._get_orders_domain(filter_by, request.args.get('q'))
 
         # Handle order duration
-        sales = Pagination(cls, domain, page, cls.per_page)
+        if 'cursor' in request.args:
+            sales = cls._get_keyset_page(domain, request.args['cursor'])
+        else:
+            sales = Pagination(cls, domain, page, cls.per_page)
+
+        cls._prefetch_for_listing(sales.items)
 
-        return render_template('sales.jinja', sales=sales)
+        return render_template(
+            'sales.jinja', sales=sales,
+            order_counts=cls.get_order_counts(request.nereid_user.party.id)
+        )
+
+    @classmethod
+    @route('/orders/export')
+    @login_required
+    def export_list(cls):
+        """Export the orders of the user with their lines
+
+        The `format` argument can be `csv` (default, one row per line) or
+        `ndjson` (one JSON document per order). The whole order history is
+        exported unless the `filter_by` argument filters the orders like
+        :py:meth:`render_list`.
+
+        The export is streamed in batches of :py:attr:`export_batch_size`
+        orders read by keyset, so the memory used does not grow with the
+        number of orders.
+        """
+        export_format = request.args.get('format', 'csv')
+        if export_format not in ('csv', 'ndjson'):
+            abort(400)
+
+        domain = cls._get_orders_domain(
+            request.args.get('filter_by', 'all'), request.args.get('q')
+        )
+
+        if export_format == 'csv':
+            rows = cls._export_csv(domain)
+            mimetype = 'text/csv'
+        else:
+            rows = cls._export_ndjson(domain)
+            mimetype = 'application/x-ndjson'
+
+        transaction = Transaction()
+        database_name = transaction.cursor.database_name
+        user, context = transaction.user, transaction.context.copy()
+
+        def generate():
+            if Transaction().cursor is not None:
+                # Still within the transaction of the request
+                for row in rows:
+                    yield row
+                return
+
+            # The transaction of the request is over by the time the
+            # response is streamed
+            with Transaction().start(
+                    database_name, user, readonly=True, context=context):
+                for row in rows:
+                    yield row
+
+        return current_app.response_class(
+            generate(), mimetype=mimetype, headers=[(
+                'Content-Disposition',
+                'attachment; filename=orders.%s' % export_format
+            )]
+        )
+
+    @classmethod
+    @route('/orders/bulk', methods=['GET', 'POST'])
+    def bulk_fetch(cls):
+        """Return JSON summaries of several orders at once
+
+        The orders are identified by comma separated `ids` and/or
+        `references`. Registered users get the orders which belong to them
+        and guests get the orders whose guest access codes are given in
+        the comma separated `access_codes`. Orders which are not found or
+        not accessible are left out.
+
+        The comma separated `fields` argument selects the fields of the
+        summaries. See :py:meth:`get_summary` for the fields available.
+        """
+        def get_list(name):
+            return filter(None, request.values.get(name, '').split(','))
+
+        try:
+            ids = map(int, get_list('ids'))
+        except ValueError:
+            abort(400)
+        references = get_list('references')
+        field_names = get_list('fields') or None
+
+        if len(ids) + len(references) > cls.bulk_fetch_limit:
+            abort(400)
+        if field_names and not set(field_names) <= set(cls._summary_fields):
+            abort(400)
+
+        if current_user.is_anonymous():
+            access_codes = get_list('access_codes')
+            if not access_codes:
+                abort(403)
+            domain = [('guest_access_code', 'in', access_codes)]
+        else:
+            domain = [('party', '=', request.nereid_user.party.id)]
+
+        if not (ids or references):
+            return jsonify(orders=[])
+
+        domain.append([
+            'OR',
+            ('id', 'in', ids),
+            ('reference', 'in', references),
+        ])
+        return jsonify(orders=[
+            sale.get_summary(field_names) for sale in cls.search(domain)
+        ])
+
+    def get_summary(self, field_names=None):
+        """
+        Return a JSON serializable summary of the order
+
+        :param field_names: A list of the fields to include, all of
+                            `_summary_fields` if not given
+        """
+        if field_names is None:
+            field_names = self._summary_fields.keys()
+        return dict(
+            (name, self._summary_fields[name](self)) for name in field_names
+        )
+
+    @classmethod
+    def _iter_export_batches(cls, domain):
+        """
+        Yield the sales matching the domain in batches
+        """
+        cursor = None
+        while True:
+            page = cls._get_keyset_page(
+                domain, cursor, per_page=cls.export_batch_size
+            )
+            cls._prefetch_for_listing(page.items)
+            yield page.items
+
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+
+    @classmethod
+    def _export_csv(cls, domain):
+        """
+        Yield the CSV export of the sales matching the domain, a batch of
+        sales at a time
+        """
+        def encode(value):
+            if value is None:
+                return ''
+            return unicode(value).encode('utf-8')
+
+        header = [
+            'Order', 'Date', 'State', 'Currency', 'Total', 'Product Code',
+            'Product', 'Description', 'Quantity', 'Unit Price', 'Amount',
+        ]
+        for index, sales in enumerate(cls._iter_export_batches(domain)):
+            buf = StringIO()
+            writer = csv.writer(buf)
+            if index == 0:
+                writer.writerow(header)
+            for sale in sales:
+                for line in sale.lines:
+                    if line.type != 'line':
+                        continue
+                    writer.writerow(map(encode, [
+                        sale.reference, sale.sale_date, sale.state,
+                        sale.currency.code, sale.total_amount,
+                        line.product and line.product.code,
+                        line.product and line.product.name,
+                        line.description, line.quantity, line.unit_price,
+                        line.amount,
+                    ]))
+            yield buf.getvalue()
+
+    @classmethod
+    def _export_ndjson(cls, domain):
+        """
+        Yield the newline delimited JSON export of the sales matching the
+        domain, a batch of sales at a time
+        """
+        for sales in cls._iter_export_batches(domain):
+            yield ''.join(
+                json.dumps(sale._get_export_data()) + '\n' for sale in sales
+            )
+
+    def _get_export_data(self):
+        """
+        Return a JSON serializable dictionary of the order and its lines
+        for the export of the order history
+        """
+        return {
+            'reference': self.reference,
+            'date': self.sale_date.isoformat(),
+            'state': self.state,
+            'currency': self.currency.code,
+            'total': str(self.total_amount),
+            'lines': [{
+                'product_code': line.product and line.product.code,
+                'product': line.product and line.product.name,
+                'description': line.description,
+                'quantity': line.quantity,
+                'unit_price': str(line.unit_price),
+                'amount': str(line.amount),
+            } for line in self.lines if line.type == 'line'],
+        }
+
+    @classmethod
+    def _prefetch_for_listing(cls, sales):
+        """
+        Read the records rendered by the orders listing for all the sales of
+        a page in a fixed number of bulk reads.
+
+        The sales are expected to share a single browse list (as returned by
+        search) so that reading a field of one of them reads it for all of
+        them. The related records are walked one level at a time, so that
+        each level is read in bulk too, before the template touches them
+        row by row.
+
+        Downstream modules which render more fields in the listing can
+        extend this to prefetch them.
+        """
+        addresses = set()
+        lines = []
+        for sale in sales:
+            sale.currency.code
+            if sale.shipment_address:
+                addresses.add(sale.shipment_address)
+            lines.extend(sale.lines)
+
+        for address in addresses:
+            address.rec_name
+
+        for line in lines:
+            if line.product:
+                line.product.rec_name
 
     @route('/order/<int:active_id>')
     @route('/order/<int:active_id>/<confirmation>')
@@ -106,8 +978,6 @@ class Sale:
                              also passes a `True` if such an argument is proved
                              or a `False`
         """
-        NereidUser = Pool().get('nereid.user')
-
         # This Ugly type hack is for a bug in previous versions where some
         # parts of the code passed confirmation as a text
         confirmation = False if confirmation is None else True
@@ -115,6 +985,235 @@ class Sale:
         # Try to find if the user can be shown the order
         access_code = request.values.get('access_code', None)
 
+        rv = self._check_access(access_code)
+        if rv is not None:
+            return rv
+
+        if session.get('_flashes'):
+            # The page shows messages meant for this request alone
+            return render_template(
+                'sale.jinja', sale=self, confirmation=confirmation
+            )
+
+        last_modified = self.get_last_modified()
+        etag = '%s-%s-%s-%s-%s' % (
+            self.id, last_modified.strftime('%Y%m%d%H%M%S%f'),
+            Transaction().language, int(confirmation),
+            int(current_user.is_anonymous()),
+        )
+        # HTTP dates have a precision of seconds
+        last_modified = last_modified.replace(microsecond=0)
+
+        if request.if_none_match.contains(etag) or (
+                not request.if_none_match and
+                request.if_modified_since and
+                request.if_modified_since >= last_modified):
+            response = current_app.response_class(status=304)
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            return response
+
+        @after_this_request
+        def set_validators(response):
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            return response
+
+        return render_template(
+            'sale.jinja', sale=self, confirmation=confirmation,
+            order_fragment=self.render_fragment(last_modified)
+        )
+
+    def render_fragment(self, version=None):
+        """
+        Render the part of the order page which depends on the order alone
+        with the :py:attr:`fragment_template`, which gets the sale alone.
+        The page template gets it as `order_fragment`. Return None if the
+        theme has no such template.
+
+        If :py:attr:`cache_rendered_order` is set, the fragments are cached
+        by the sale, its version and the language.
+
+        :param version: The last modification of the sale, as returned by
+                        :py:meth:`get_last_modified`
+        """
+        if version is None:
+            version = self.get_last_modified()
+
+        cache_key = None
+        if self.cache_rendered_order:
+            cache_key = (self.id, version, Transaction().language)
+            fragment = self._render_cache.get(cache_key)
+            if fragment is not None:
+                return Markup(fragment)
+
+        try:
+            template = current_app.jinja_env.get_template(
+                self.fragment_template
+            )
+        except TemplateNotFound:
+            return None
+
+        fragment = template.render(sale=self)
+        if cache_key is not None:
+            self._render_cache.set(cache_key, fragment)
+        return Markup(fragment)
+
+    @route('/order/<int:active_id>/status')
+    def render_status(self):
+        """Return the state of the order as a tiny JSON document
+
+        The document has the state of the sale, its payments and its
+        shipments, and a version which is also sent as the ETag. If the
+        `If-None-Match` header matches the version, a 304 is returned.
+
+        If a `wait` argument (in seconds) is given, the request is held
+        till the version changes or the wait (capped to
+        :py:attr:`status_poll_timeout`) is over, so that clients can
+        long-poll instead of polling repeatedly. The status is checked
+        every :py:attr:`status_poll_interval` seconds meanwhile, and no
+        database transaction is left open while waiting.
+
+        A request waiting holds a worker of the WSGI server, so `wait` is
+        only meant for servers with threaded or asynchronous (gevent,
+        eventlet) workers. With a few synchronous workers, the clients
+        should poll without it.
+        """
+        access_code = request.values.get('access_code', None)
+
+        rv = self._check_access(access_code)
+        if rv is not None:
+            return rv
+
+        wait = min(
+            request.args.get('wait', 0, type=int), self.status_poll_timeout
+        )
+        deadline = time.time() + wait
+
+        status = self.get_status()
+        while request.if_none_match.contains(status['version']) and \
+                time.time() < deadline:
+            # Do not keep the transaction (and its snapshot) open while
+            # waiting, the status is read afresh after
+            Transaction().cursor.rollback()
+            time.sleep(self.status_poll_interval)
+            status = self._get_fresh_status()
+
+        if request.if_none_match.contains(status['version']):
+            response = current_app.response_class(status=304)
+        else:
+            response = jsonify(status)
+        response.set_etag(status['version'])
+        return response
+
+    def _get_fresh_status(self):
+        """
+        Return the status of the sale as committed by now. The transaction
+        is started afresh and the records it cached are dropped, so that
+        nothing is read from before.
+        """
+        cursor = Transaction().cursor
+        cursor.rollback()
+        cursor.cache.clear()
+        return self.__class__(self.id).get_status()
+
+    def get_status(self):
+        """
+        Return a dictionary with the state of the sale, its payments and
+        its shipments, and a version which changes with any of them or
+        with the sale.
+        """
+        if self.payment_captured >= self.total_amount:
+            payment_state = 'captured'
+        elif self.payment_captured + self.payment_authorized >= \
+                self.total_amount:
+            payment_state = 'authorized'
+        else:
+            payment_state = 'pending'
+
+        status = {
+            'state': self.state,
+            'payment_state': payment_state,
+            'shipment_state': self.shipment_state,
+        }
+        # Captures do not modify the sale or its payments, so the states
+        # are a part of the version too
+        status['version'] = sha1(repr((
+            self.id, self.get_last_modified(), sorted(status.items())
+        ))).hexdigest()
+        return status
+
+    def get_last_modified(self):
+        """
+        Return the time the sale, its lines or its payments were last
+        modified. This is used as the version of the rendered order.
+
+        It is read with a single query, the lines and payments are not
+        read.
+        """
+        SaleLine = Pool().get('sale.line')
+        SalePayment = Pool().get('sale.payment')
+        cursor = Transaction().cursor
+
+        sale = self.__table__()
+        line = SaleLine.__table__()
+        payment = SalePayment.__table__()
+
+        cursor.execute(*Union(
+            sale.select(
+                Max(Coalesce(sale.write_date, sale.create_date)),
+                where=sale.id == self.id
+            ),
+            line.select(
+                Max(Coalesce(line.write_date, line.create_date)),
+                where=line.sale == self.id
+            ),
+            payment.select(
+                Max(Coalesce(payment.write_date, payment.create_date)),
+                where=payment.sale == self.id
+            ),
+            all_=True
+        ))
+        return max(
+            to_datetime(value) for value, in cursor.fetchall() if value
+        )
+
+    @classmethod
+    @route('/order/access/<access_code>')
+    def render_by_access_code(cls, access_code):
+        """Render the sale order with the given guest access code
+
+        The sale is looked up by the indexed guest access code alone, so
+        links need not carry the ID of the sale.
+
+        :param access_code: The guest access code of the sale
+        """
+        sales = cls.search([
+            ('guest_access_code', '=', access_code),
+        ], limit=1)
+        if not sales:
+            abort(404)
+
+        sale, = sales
+        rv = sale._check_access(access_code)
+        if rv is not None:
+            return rv
+
+        return render_template('sale.jinja', sale=sale, confirmation=False)
+
+    def _check_access(self, access_code=None):
+        """
+        Check if the current user can be shown the order. Guests need the
+        access code of the order and registered users need to own it.
+
+        Aborts with 403 if the order is not accessible, and returns the
+        response of the unauthorized handler if a guest has no access code.
+        Returns None if the order is accessible.
+
+        :param access_code: The access code provided by the user
+        """
+        NereidUser = Pool().get('nereid.user')
+
         if current_user.is_anonymous():
             if not access_code:
                 # No access code provided, user is not authorized to
@@ -128,22 +1227,119 @@ class Sale:
                 # Order does not belong to the user
                 abort(403)
 
-        return render_template(
-            'sale.jinja', sale=self, confirmation=confirmation
-        )
+    @classmethod
+    def create(cls, vlist):
+        SaleOrderCount = Pool().get('sale.sale.order_count')
+
+        sales = super(Sale, cls).create(vlist)
+        if any(v.get('state', 'draft') != 'draft' for v in vlist):
+            SaleOrderCount.update_counts(
+                [], SaleOrderCount.read_keys(map(int, sales))
+            )
+        return sales
+
+    @classmethod
+    def write(cls, *args):
+        SaleOrderCount = Pool().get('sale.sale.order_count')
+
+        # State transitions (confirm, process, cancel, done ...) are
+        # written through here and change the order counts of the parties
+        # of the sales
+        actions = iter(args)
+        counted_ids = set()
+        for sales, values in zip(actions, actions):
+            if set(values) & set(['state', 'sale_date', 'party']):
+                counted_ids.update(map(int, sales))
+        counted_ids = list(counted_ids)
+        if counted_ids:
+            old_keys = SaleOrderCount.read_keys(counted_ids)
+
+        super(Sale, cls).write(*args)
+
+        if counted_ids:
+            SaleOrderCount.update_counts(
+                old_keys, SaleOrderCount.read_keys(counted_ids)
+            )
+
+        actions = iter(args)
+        sale_ids = set()
+        for sales, values in zip(actions, actions):
+            if set(values) & set([
+                    'reference', 'shipment_address', 'invoice_address']):
+                sale_ids.update(map(int, sales))
+        if sale_ids:
+            cls._refresh_search_text(sale_ids)
+
+    @classmethod
+    def delete(cls, sales):
+        SaleOrderCount = Pool().get('sale.sale.order_count')
+
+        old_keys = SaleOrderCount.read_keys(map(int, sales))
+        super(Sale, cls).delete(sales)
+        SaleOrderCount.update_counts(old_keys, [])
+
+    @classmethod
+    def set_reference(cls, sales):
+        """
+        Draw the references from blocks reserved by this process, if the
+        sale configuration has a block size. See
+        :py:class:`ReferenceAllocator`.
+        """
+        Config = Pool().get('sale.configuration')
+
+        config = Config(1)
+        block_size = config.sale_reference_block_size
+        if not block_size or block_size <= 1 or \
+                not reference_allocator.supports(config.sale_sequence):
+            return super(Sale, cls).set_reference(sales)
+
+        args = []
+        for sale in sales:
+            if sale.reference:
+                continue
+            args.extend([[sale], {
+                'reference': reference_allocator.next(
+                    config.sale_sequence, block_size
+                ),
+            }])
+        if args:
+            cls.write(*args)
 
     @classmethod
     def confirm(cls, sales):
         "Send an email after sale is confirmed"
+        Party = Pool().get('party.party')
+
         super(Sale, cls).confirm(sales)
 
-        if has_request_context():
+        if has_request_context() and current_user.is_anonymous():
+            # Change party name to invoice address name for guest user
+            parties_by_name = {}
             for sale in sales:
+                name = sale.invoice_address.name
+                if sale.party.name != name:
+                    parties_by_name.setdefault(name, set()).add(sale.party)
+
+            args = []
+            for name, parties in parties_by_name.iteritems():
+                args.extend([list(parties), {'name': name}])
+            if args:
+                Party.write(*args)
+
+        # The JSON-LD needs a request to build the URLs, and is otherwise
+        # built whenever it is needed
+        json_lds = [None] * len(sales)
+        if has_request_context():
+            json_lds = cls.get_json_ld(sales)
 
-                # Change party name to invoice address name for guest user
-                if current_user.is_anonymous():
-                    sale.party.name = sale.invoice_address.name
-                    sale.party.save()
+        args = []
+        for sale, json_ld in zip(sales, json_lds):
+            values = {'search_text': sale.get_search_text()}
+            if json_ld is not None:
+                values['json_ld'] = json.dumps(json_ld, separators=(',', ':'))
+            args.extend([[sale], values])
+        if args:
+            cls.write(*args)
 
     def validate_payment_profile(self, payment_profile):
         """
@@ -171,18 +1367,13 @@ class Sale:
         All payment profiles are saved as of now.
         """
 
-        AddSalePaymentWizard = Pool().get(
-            'sale.payment.add', type="wizard"
-        )
-
-        payment_wizard = AddSalePaymentWizard(
-            AddSalePaymentWizard.create()[0]
-        )
-
         if request.nereid_website.credit_card_gateway and (
             payment_profile or credit_card_form
         ):
             gateway = request.nereid_website.credit_card_gateway
+            payment_wizard = self._get_payment_wizard(
+                gateway, self._get_amount_to_checkout()
+            )
 
             if payment_profile:
                 self.validate_payment_profile(payment_profile)
@@ -209,36 +1400,244 @@ class Sale:
                 payment_wizard.payment_info.csc = credit_card_form.cvv.data
 
         elif alternate_payment_method:
-            gateway = alternate_payment_method.gateway
+            payment_wizard = self._get_payment_wizard(
+                alternate_payment_method.gateway,
+                self._get_amount_to_checkout()
+            )
             payment_wizard.payment_info.use_existing_card = False
             payment_wizard.payment_info.payment_profile = None
 
+        with Transaction().set_context(active_id=self.id):
+            try:
+                payment_wizard.transition_add()
+            except UserError, e:
+                flash(e.message)
+                abort(redirect(request.referrer))
+
+    def _get_payment_wizard(self, gateway, amount):
+        """
+        Return a `sale.payment.add` wizard filled in to pay the given amount
+        of the sale with the gateway. The card or payment profile is left to
+        the caller.
+        """
+        AddSalePaymentWizard = Pool().get(
+            'sale.payment.add', type="wizard"
+        )
+
+        payment_wizard = AddSalePaymentWizard(
+            AddSalePaymentWizard.create()[0]
+        )
+
         payment_wizard.payment_info.sale = self.id
         payment_wizard.payment_info.party = self.party.id
         payment_wizard.payment_info.credit_account = \
             self.party.account_receivable.id
         payment_wizard.payment_info.currency_digits = self.currency_digits
-        payment_wizard.payment_info.amount = self._get_amount_to_checkout()
+        payment_wizard.payment_info.amount = amount
         payment_wizard.payment_info.reference = self.reference
 
         payment_wizard.payment_info.method = gateway.method
         payment_wizard.payment_info.provider = gateway.provider
         payment_wizard.payment_info.gateway = gateway
+        return payment_wizard
 
-        with Transaction().set_context(active_id=self.id):
-            try:
+    def _get_pre_authorized_payment(self):
+        """
+        Return the sale payment authorized on a payment profile while the
+        customer was still on the payment page, or None.
+        """
+        SalePayment = Pool().get('sale.payment')
+
+        if self.state != 'draft':
+            return None
+
+        payments = SalePayment.search([
+            ('sale', '=', self.id),
+            ('pre_authorization', '=', True),
+        ], limit=1)
+        return payments[0] if payments else None
+
+    @staticmethod
+    def _get_authorized_amount(payment):
+        """
+        Return the amount authorized by the gateway on the sale payment
+        """
+        return sum(
+            t.amount for t in payment.payment_transactions
+            if t.state == 'authorized'
+        )
+
+    def pre_authorize_payment_profile(self, payment_profile):
+        """
+        Add a sale payment on the payment profile for the amount to checkout
+        and authorize it right away, voiding any earlier pre-authorization.
+
+        The final submission of the payment page only has to confirm the
+        order if the pre-authorization is still valid. See
+        :py:meth:`_use_pre_authorization`.
+
+        The errors of the gateway are raised as user errors, for the caller
+        to report them.
+        """
+        SalePayment = Pool().get('sale.payment')
+
+        self._void_pre_authorization()
+
+        # Reload the sale as the payment totals change with the payments
+        sale = self.__class__(self.id)
+        payment_wizard = sale._get_payment_wizard(
+            request.nereid_website.credit_card_gateway,
+            sale._get_amount_to_checkout()
+        )
+        payment_wizard.payment_info.use_existing_card = True
+        payment_wizard.payment_info.payment_profile = payment_profile.id
+        with Transaction().set_context(active_id=sale.id):
+            payment_wizard.transition_add()
+
+        payment, = SalePayment.search([
+            ('sale', '=', sale.id),
+            ('payment_profile', '=', payment_profile.id),
+        ], order=[('id', 'DESC')], limit=1)
+        SalePayment.write([payment], {'pre_authorization': True})
+
+        sale.authorize_payments(payment.amount)
+        return payment
+
+    def _void_pre_authorization(self):
+        """
+        Void the transactions of the pre-authorized payment, if any, and
+        remove the payment from the sale.
+        """
+        SalePayment = Pool().get('sale.payment')
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        payment = self._get_pre_authorized_payment()
+        if payment is None:
+            return
+
+        transactions = [
+            t for t in payment.payment_transactions if t.state == 'authorized'
+        ]
+        if transactions:
+            PaymentTransaction.cancel(transactions)
+        SalePayment.delete([payment])
+
+    def _use_pre_authorization(self, payment_profile):
+        """
+        Return True if the sale has a pre-authorized payment on the given
+        profile, which the gateway authorized for the current amount to
+        checkout. A stale pre-authorization (another profile, a changed
+        amount or a declined authorization) is voided.
+        """
+        payment = self._get_pre_authorized_payment()
+        if payment is None:
+            return False
+
+        sale = self.__class__(self.id)
+        amount = sale.total_amount - sale.payment_total + payment.amount
+        if payment.payment_profile == payment_profile and \
+                payment.amount == amount and \
+                self._get_authorized_amount(payment) == amount:
+            return True
+
+        self._void_pre_authorization()
+        return False
+
+    def _add_sale_payments(self, allocations):
+        """
+        Split the payment of the sale across several payment methods, for
+        example a gift card and a credit card, or two credit cards.
+
+        Each payment is added with the `sale.payment.add` wizard, like
+        :py:meth:`_add_sale_payment`, and all of them are then authorized.
+        If any of them is not authorized, the authorizations obtained are
+        voided, the payments added are removed and a user error is raised:
+        either all the payments are recorded or none, even if the caller
+        handles the error.
+
+        :param allocations: A list of (method, amount) tuples where method
+                            is an active record of `party.payment_profile`
+                            or `nereid.website.payment_method`
+        :return: The list of sale payments created
+        """
+        SalePayment = Pool().get('sale.payment')
+        PaymentProfile = Pool().get('party.payment_profile')
+        PaymentMethod = Pool().get('nereid.website.payment_method')
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        amount_to_checkout = self._get_amount_to_checkout()
+        total = sum(amount for method, amount in allocations)
+        if total > amount_to_checkout:
+            self.raise_user_error(
+                'split_exceeds_total', (total, amount_to_checkout)
+            )
+
+        for method, amount in allocations:
+            if amount <= 0:
+                self.raise_user_error(
+                    'invalid_split_amount', (amount, method.rec_name)
+                )
+            if isinstance(method, PaymentProfile):
+                if method.party != self.party:
+                    self.raise_user_error(
+                        'invalid_split_profile', (method.rec_name, )
+                    )
+            elif not isinstance(method, PaymentMethod):
+                self.raise_user_error('invalid_split_method', (method, ))
+
+        existing = map(int, self.payments)
+        for method, amount in allocations:
+            payment_wizard = self._get_payment_wizard(
+                method.gateway, self.currency.round(amount)
+            )
+            if isinstance(method, PaymentProfile):
+                payment_wizard.payment_info.use_existing_card = True
+                payment_wizard.payment_info.payment_profile = method.id
+            else:
+                payment_wizard.payment_info.use_existing_card = False
+                payment_wizard.payment_info.payment_profile = None
+            with Transaction().set_context(active_id=self.id):
                 payment_wizard.transition_add()
-            except UserError, e:
-                flash(e.message)
-                abort(redirect(request.referrer))
+
+        payments = SalePayment.search([
+            ('sale', '=', self.id),
+            ('id', 'not in', existing),
+        ], order=[('id', 'ASC')])
+
+        # Reload the sale as the payment totals change with the payments
+        sale = self.__class__(self.id)
+        sale.authorize_payments(total)
+
+        payments = SalePayment.browse(map(int, payments))
+        failed = [
+            p for p in payments if self._get_authorized_amount(p) != p.amount
+        ]
+        if failed:
+            authorized = [
+                t for p in payments for t in p.payment_transactions
+                if t.state == 'authorized'
+            ]
+            if authorized:
+                PaymentTransaction.cancel(authorized)
+            gateway = failed[0].gateway.rec_name
+
+            # Remove the payments of the batch, so that a caller handling
+            # the error does not keep a part of them
+            SalePayment.delete(payments)
+            self.raise_user_error('split_authorization_failed', (gateway, ))
+        return payments
 
     @route('/order/<int:active_id>/add-comment', methods=['POST'])
     def add_comment_to_sale(self):
         """
         Add comment to sale.
 
-        User can add comment or note to sale order.
+        User can add comment or note to sale order. Each comment is
+        appended to the comments of the order, the sale itself is not
+        written.
         """
+        SaleComment = Pool().get('sale.sale.comment')
+
         comment_is_allowed = False
 
         if self.state not in self.comment_allowed_states:
@@ -257,19 +1656,55 @@ class Sale:
         if not comment_is_allowed:
             abort(403)
 
-        if request.form.get('comment') and not self.comment \
-                and self.state in self.comment_allowed_states:
-            self.comment = request.form.get('comment')
-            self.save()
+        if request.form.get('comment'):
+            comment, = SaleComment.create([{
+                'sale': self.id,
+                'comment': request.form.get('comment'),
+                'nereid_user': (
+                    None if current_user.is_anonymous() else current_user.id
+                ),
+            }])
             if request.is_xhr:
                 return jsonify({
                     'message': 'Comment Added',
-                    'comment': self.comment,
+                    'comment': comment.serialize(),
                 })
 
             flash(_('Comment Added'))
         return redirect(request.referrer)
 
+    def get_comments(self, page=1):
+        """
+        Return a page of the comments of the order, oldest first. Only the
+        comments of the requested page are read.
+
+        :param page: The page number
+        """
+        SaleComment = Pool().get('sale.sale.comment')
+
+        return Pagination(
+            SaleComment, [('sale', '=', self.id)], page,
+            self.comments_per_page
+        )
+
+    @route('/order/<int:active_id>/comments')
+    @route('/order/<int:active_id>/comments/<int:page>')
+    def render_comments(self, page=1):
+        """
+        Return a page of the comments of the order as JSON
+        """
+        rv = self._check_access(request.values.get('access_code', None))
+        if rv is not None:
+            return rv
+
+        comments = self.get_comments(page)
+        return jsonify({
+            'comments': [comment.serialize() for comment in comments.items],
+            'page': page,
+            'pages': comments.pages,
+            'count': comments.count,
+        })
+
     def _get_amount_to_checkout(self):
         """
         Returns the amount which needs to be paid
@@ -285,40 +1720,251 @@ class Sale:
         """
         context = super(Sale, self)._get_email_template_context()
 
+        if has_request_context():
+            prepare_email_templates(current_app.jinja_env)
+
         if has_request_context() and not current_user.is_anonymous():
             customer_name = current_user.display_name
         else:
             customer_name = self.party.name
 
+        context.update(EMAIL_TEMPLATE_HELPERS)
         context.update({
-            'url_for': lambda *args, **kargs: url_for(*args, **kargs),
-            'has_request_context': lambda *args, **kargs: has_request_context(
-                *args, **kargs),
             'current_user': current_user,
             'customer_name': customer_name,
-            'to_json': lambda *args, **kargs: json.dumps(*args, **kargs),
         })
         return context
 
+    def _get_confirmation_email_subject(self):
+        """
+        Return the subject of the confirmation email of the sale
+        """
+        return unicode(_(
+            'Order Confirmation #%(reference)s', reference=self.reference
+        ))
+
+    def _get_confirmation_email_values(self):
+        """
+        Return the values of the `email.queue` record of the confirmation
+        email of the sale, or None if the sale has no receiver.
+
+        Both the email sent on confirmation and the emails resent by
+        :py:meth:`resend_confirmation_emails` are built here, so that their
+        subject and templates cannot drift apart.
+        """
+        to_addrs = self._get_receiver_email_address()
+        if not to_addrs:
+            return None
+
+        from_addr = config.get('email', 'from')
+        message = render_email(
+            from_addr, to_addrs, self._get_confirmation_email_subject(),
+            text_template=EMAIL_TEMPLATES[0],
+            html_template=EMAIL_TEMPLATES[1],
+            **self._get_email_template_context()
+        )
+        return {
+            'from_addr': from_addr,
+            'to_addrs': ','.join(to_addrs),
+            'msg': message.as_string(),
+        }
+
+    def send_confirmation_email(self, silent=True):
+        """
+        Queue the confirmation email of the sale, as built by
+        :py:meth:`_get_confirmation_email_values`
+
+        :param silent: If True, an email which cannot be rendered is logged
+                       instead of raising the error
+        """
+        EmailQueue = Pool().get('email.queue')
+
+        try:
+            values = self._get_confirmation_email_values()
+        except Exception:
+            if not silent:
+                raise
+            logger.exception(
+                'Confirmation email of sale %s could not be sent', self.id
+            )
+            return
+        if values is not None:
+            EmailQueue.create([values])
+
+    @classmethod
+    def resend_confirmation_emails(cls, domain, chunk_size=100, progress=None):
+        """
+        Render the confirmation emails of the sales matching the domain and
+        queue them to be sent again, for example after a template fix.
+
+        The emails are built like the email sent on confirmation (see
+        :py:meth:`_get_confirmation_email_values`). The sales are handled in
+        chunks: the records rendered by the templates are prefetched for
+        each chunk, the templates are compiled once, the receivers are
+        resolved with a query per chunk (each party only once for the whole
+        job) and the emails of a chunk are queued with a single insert.
+
+        The emails are sent to the parties alone, never to the user running
+        the job.
+
+        This needs an application and request context to render the
+        templates. See the `resend_emails` script for a command line
+        interface.
+
+        :param domain: The domain of the sales
+        :param chunk_size: Number of sales rendered at a time
+        :param progress: A function called after each chunk with the number
+                         of sales done, the total number of sales, the
+                         number of emails queued and the seconds elapsed
+        :return: The number of emails queued
+        """
+        EmailQueue = Pool().get('email.queue')
+
+        prepare_email_templates(current_app.jinja_env)
+
+        ids = map(int, cls.search(domain, order=[('id', 'ASC')]))
+        started, queued = time.time(), 0
+        emails = {}
+        for index in xrange(0, len(ids), chunk_size):
+            sales = cls.browse(ids[index:index + chunk_size])
+            cls._prefetch_for_listing(sales)
+            receivers = cls.get_receiver_email_addresses(
+                sales, memo=emails, include_user=False
+            )
+
+            vlist = []
+            for sale in sales:
+                sale._receiver_email_addresses = receivers[sale.id]
+                values = sale._get_confirmation_email_values()
+                if values is not None:
+                    vlist.append(values)
+            if vlist:
+                queued += len(EmailQueue.create(vlist))
+
+            if progress is not None:
+                progress(
+                    index + len(sales), len(ids), queued,
+                    time.time() - started
+                )
+        return queued
+
+    @classmethod
+    def get_receiver_email_addresses(cls, sales, memo=None, include_user=True):
+        """
+        Return a dictionary mapping the id of each sale to the list of
+        email addresses its emails are sent to: the email of the party and
+        (unless include_user is False) of the current user.
+
+        The emails of all the parties are read with a single query. Parties
+        found in `memo` are not read again, so a job sending emails in
+        several chunks can pass the same dictionary for each chunk.
+
+        :param sales: The sales
+        :param memo: A dictionary of party id to its email (or None), which
+                     is updated with the parties read
+        :param include_user: Whether to add the email of the current user
+        """
+        ContactMechanism = Pool().get('party.contact_mechanism')
+
+        if memo is None:
+            memo = {}
+
+        party_ids = set(sale.party.id for sale in sales) - set(memo)
+        if party_ids:
+            memo.update(dict.fromkeys(party_ids))
+            # The mechanisms are in the same order as on the party, so the
+            # first email of each party is the one party.email returns
+            for mechanism in ContactMechanism.search([
+                        ('party', 'in', list(party_ids)),
+                        ('type', '=', 'email'),
+                    ]):
+                if memo[mechanism.party.id] is None:
+                    memo[mechanism.party.id] = mechanism.value
+
+        user_email = None
+        if include_user and has_request_context() and \
+                not current_user.is_anonymous() and current_user.email:
+            user_email = current_user.email.lower()
+
+        result = {}
+        for sale in sales:
+            to_emails = set()
+            if memo[sale.party.id]:
+                to_emails.add(memo[sale.party.id].lower())
+            if user_email:
+                to_emails.add(user_email)
+            result[sale.id] = list(to_emails)
+        return result
+
     def _get_receiver_email_address(self):
         """
         Update reciever's email address(s)
+
+        See :py:meth:`get_receiver_email_addresses`. The addresses already
+        resolved by :py:meth:`resend_confirmation_emails` are used if set.
         """
-        to_emails = set()
-        if self.party.email:
-            to_emails.add(self.party.email.lower())
-        if has_request_context() and not current_user.is_anonymous() and \
-                current_user.email:
-            to_emails.add(current_user.email.lower())
+        if self._receiver_email_addresses is not None:
+            return self._receiver_email_addresses
+        return self.get_receiver_email_addresses([self])[self.id]
 
-        return list(to_emails)
+    @classmethod
+    def get_json_ld(cls, sales):
+        """
+        Return the Gmail markup (as by :py:meth:`as_json_ld`) of several
+        sales at once, in the same order as the sales.
 
-    def as_json_ld(self):
+        The parties, companies, currencies, lines, products and addresses
+        of all the sales are read in bulk first, and the URLs of the
+        products are built once per product.
+        """
+        sales = cls.browse([s.id for s in sales])
+        if all(sale.json_ld for sale in sales):
+            return [json.loads(sale.json_ld) for sale in sales]
+
+        lines = []
+        addresses = set()
+        for sale in sales:
+            sale.party.name
+            sale.company.rec_name
+            sale.currency.code
+            lines.extend(sale.lines)
+            if sale.invoice_address:
+                addresses.add(sale.invoice_address)
+
+        for line in lines:
+            if line.product:
+                line.product.uri
+
+        for address in addresses:
+            if address.subdivision:
+                address.subdivision.rec_name
+            if address.country:
+                address.country.rec_name
+
+        urls = {}
+
+        def product_url(uri):
+            if uri not in urls:
+                urls[uri] = get_product_url(uri)
+            return urls[uri]
+
+        return [sale.as_json_ld(product_url=product_url) for sale in sales]
+
+    def as_json_ld(self, product_url=None):
         """
         Gmail markup for order information
 
         https://developers.google.com/gmail/markup/reference/order
+
+        The snapshot taken when the sale was confirmed is returned if it is
+        still valid.
+
+        :param product_url: A function which returns the URL of a product
+                            from its uri. See :py:meth:`get_json_ld`
         """
+        if self.json_ld:
+            return json.loads(self.json_ld)
+
         data = {
             "@context": "http://schema.org",
             "@type": "Order",
@@ -347,7 +1993,9 @@ class Sale:
         for line in self.lines:
             if not line.type == 'line' and not line.product:
                 continue
-            data["acceptedOffer"].append(line.as_json_ld())
+            data["acceptedOffer"].append(
+                line.as_json_ld(product_url=product_url)
+            )
 
         if self.invoice_address:
             data["billingAddress"] = {
@@ -364,22 +2012,72 @@ class Sale:
 class SaleLine:
     __name__ = 'sale.line'
 
-    def as_json_ld(self):
+    @classmethod
+    def _clear_sale_json_ld(cls, lines):
+        """
+        Clear the JSON-LD snapshot of the sales of the lines, so that it is
+        built again with the modified lines
+        """
+        Sale = Pool().get('sale.sale')
+
+        sales = Sale.browse(list(set(line.sale.id for line in lines)))
+        sales = [sale for sale in sales if sale.json_ld]
+        if sales:
+            Sale.write(sales, {'json_ld': None})
+
+    @classmethod
+    def create(cls, vlist):
+        Sale = Pool().get('sale.sale')
+
+        lines = super(SaleLine, cls).create(vlist)
+        cls._clear_sale_json_ld(lines)
+        Sale._refresh_search_text(set(line.sale.id for line in lines))
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        Sale = Pool().get('sale.sale')
+
+        super(SaleLine, cls).write(*args)
+        cls._clear_sale_json_ld(sum(args[::2], []))
+
+        # Only the products of the lines are in the search text
+        actions = iter(args)
+        sale_ids = set()
+        for lines, values in zip(actions, actions):
+            if 'product' in values:
+                sale_ids.update(line.sale.id for line in lines)
+        Sale._refresh_search_text(sale_ids)
+
+    @classmethod
+    def delete(cls, lines):
+        Sale = Pool().get('sale.sale')
+
+        sale_ids = set(line.sale.id for line in lines)
+        cls._clear_sale_json_ld(lines)
+        super(SaleLine, cls).delete(lines)
+        Sale._refresh_search_text(sale_ids)
+
+    def as_json_ld(self, product_url=None):
         """
         Gmail markup for order line information
 
         https://developers.google.com/gmail/markup/reference/order
+
+        :param product_url: A function which returns the URL of a product
+                            from its uri
         """
+        if product_url is None:
+            product_url = get_product_url
+
         return {
             "@type": "Offer",
             "itemOffered": {
                 "@type": "Product",
                 "name": self.product.name,
                 "sku": self.product.code,
-                "url": url_for(
-                    'product.product.render',
-                    uri=self.product.uri,
-                    _external=True
+                "url": product_url(
+                    self.product.uri
                 ) if self.product.uri else None
             },
             "price": str(self.amount),
@@ -389,3 +2087,362 @@ class SaleLine:
                 "value": self.quantity,
             }
         }
+
+
+class SalePayment:
+    __name__ = 'sale.payment'
+
+    #: Set on the payment authorized on a payment profile while the
+    #: customer was still on the payment page. See
+    #: :py:meth:`Sale.pre_authorize_payment_profile`
+    pre_authorization = fields.Boolean('Pre-Authorization', readonly=True)
+
+    @staticmethod
+    def default_pre_authorization():
+        return False
+
+
+class SaleOrderCount(ModelSQL):
+    """
+    Order Count
+
+    The number of orders of a party in a state with a sale date. These are
+    kept up to date by the sales as they are created, change state (or
+    date or party) and are deleted, so that the counts of the orders
+    listing are a single indexed read (see :py:meth:`Sale.get_order_counts`)
+    and a transition only updates the counts of the party of the sale.
+
+    The drafts and quotations, which are not listed, are not counted.
+    """
+    __name__ = 'sale.sale.order_count'
+
+    party = fields.Many2One(
+        'party.party', 'Party', required=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    state = fields.Char('State', required=True, readonly=True)
+    sale_date = fields.Date('Sale Date', readonly=True)
+    count = fields.Integer('Count', required=True, readonly=True)
+
+    #: States of the sales which are not counted
+    uncounted_states = ('draft', 'quotation')
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        created = not TableHandler.table_exist(cursor, cls._table)
+
+        super(SaleOrderCount, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['party', 'state', 'sale_date'], 'add')
+
+        if created:
+            # Count the existing sales
+            counter = cls.__table__()
+            sale = Pool().get('sale.sale').__table__()
+            cursor.execute(*counter.insert(
+                columns=[
+                    counter.party, counter.state, counter.sale_date,
+                    counter.count,
+                ],
+                values=sale.select(
+                    sale.party, sale.state, sale.sale_date,
+                    Count(Literal(1)),
+                    where=~sale.state.in_(cls.uncounted_states),
+                    group_by=[sale.party, sale.state, sale.sale_date]
+                )
+            ))
+
+    @classmethod
+    def get_counts(cls, party, archive_date):
+        """
+        Return the number of orders of the party as a list of tuples of the
+        state, whether the orders are archived (None if they have no sale
+        date) and the count
+
+        :param party: ID of the party
+        :param archive_date: The date before which orders are archived
+        """
+        counter = cls.__table__()
+        cursor = Transaction().cursor
+        archived = counter.sale_date < archive_date
+
+        cursor.execute(*counter.select(
+            counter.state, archived, Sum(counter.count),
+            where=(counter.party == party),
+            group_by=[counter.state, archived],
+        ))
+        return [
+            (state, is_archived, int(count))
+            for state, is_archived, count in cursor.fetchall()
+        ]
+
+    @classmethod
+    def read_keys(cls, sale_ids):
+        """
+        Return the list of the (party, state, sale_date) keys the sales are
+        counted by, as they are in the database
+
+        :param sale_ids: The IDs of the sales
+        """
+        sale = Pool().get('sale.sale').__table__()
+        cursor = Transaction().cursor
+
+        keys = []
+        for index in xrange(0, len(sale_ids), cursor.IN_MAX):
+            cursor.execute(*sale.select(
+                sale.party, sale.state, sale.sale_date,
+                where=sale.id.in_(sale_ids[index:index + cursor.IN_MAX]) &
+                ~sale.state.in_(cls.uncounted_states)
+            ))
+            keys.extend(cursor.fetchall())
+        return keys
+
+    @classmethod
+    def update_counts(cls, old_keys, new_keys):
+        """
+        Move the sales from the counts of their old keys to the counts of
+        their new keys. Only the counts which change are updated.
+
+        :param old_keys: The keys of the sales before they changed
+        :param new_keys: The keys of the sales after they changed
+        """
+        counter = cls.__table__()
+        cursor = Transaction().cursor
+
+        deltas = defaultdict(int)
+        for key in old_keys:
+            deltas[tuple(key)] -= 1
+        for key in new_keys:
+            deltas[tuple(key)] += 1
+
+        for (party, state, sale_date), delta in deltas.iteritems():
+            if not delta:
+                continue
+            where = (counter.party == party) & (counter.state == state)
+            if sale_date is None:
+                where &= (counter.sale_date == Null)
+            else:
+                where &= (counter.sale_date == sale_date)
+
+            cursor.execute(*counter.update(
+                columns=[counter.count],
+                values=[counter.count + delta],
+                where=where
+            ))
+            if not cursor.rowcount:
+                cursor.execute(*counter.insert(
+                    columns=[
+                        counter.party, counter.state, counter.sale_date,
+                        counter.count,
+                    ],
+                    values=[[party, state, sale_date, delta]]
+                ))
+
+
+class SaleComment(ModelSQL, ModelView):
+    """
+    Comment on a sale by the customer
+
+    Comments are only ever appended: they cannot be modified. The access
+    rights let sale administrators alone delete them (a comment posted by
+    mistake for example); deleting is not blocked otherwise, so that the
+    comments go with their sale when it is deleted.
+    """
+    __name__ = 'sale.sale.comment'
+
+    sale = fields.Many2One(
+        'sale.sale', 'Sale', required=True, select=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    comment = fields.Text('Comment', required=True, readonly=True)
+    nereid_user = fields.Many2One(
+        'nereid.user', 'Nereid User', readonly=True,
+        help='The user who commented, empty for guests'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(SaleComment, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'ASC'))
+        cls._error_messages.update({
+            'comment_append_only': 'Comments on sales cannot be modified.',
+        })
+
+    @classmethod
+    def create(cls, vlist):
+        """
+        Queue a comment-added event for each comment, in the same
+        transaction. See :py:class:`SaleCommentEvent`.
+        """
+        Event = Pool().get('sale.sale.comment.event')
+
+        comments = super(SaleComment, cls).create(vlist)
+        Event.create([{'comment': comment.id} for comment in comments])
+        return comments
+
+    @classmethod
+    def write(cls, *args):
+        "Comments are only ever appended"
+        cls.raise_user_error('comment_append_only')
+
+    def notify(self):
+        """
+        Notify that the comment was added. This is called by the worker
+        processing the comment events and not while the comment is posted.
+
+        The default implementation does nothing. Downstream modules which
+        notify support (by email for example) should extend this.
+        """
+        pass
+
+    def serialize(self):
+        """
+        Return a JSON serializable representation of the comment
+        """
+        return {
+            'id': self.id,
+            'comment': self.comment,
+            'create_date': self.create_date.isoformat(),
+            'user': self.nereid_user and self.nereid_user.display_name,
+        }
+
+
+class SaleCommentEvent(ModelSQL, ModelView):
+    """
+    Comment-added event
+
+    The events are queued when a comment is added and processed later by
+    the worker (a cron) calling :py:meth:`process_all`, like the email
+    queue, so that the notification does not delay the response to the
+    customer.
+    """
+    __name__ = 'sale.sale.comment.event'
+
+    comment = fields.Many2One(
+        'sale.sale.comment', 'Comment', required=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+
+    #: Number of times an event is attempted before it is marked failed
+    max_attempts = 3
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def process(cls, events):
+        """
+        Notify the comments of the events and mark them done
+        """
+        for event in events:
+            event.comment.notify()
+        cls.write(events, {'state': 'done'})
+
+    @classmethod
+    def process_all(cls):
+        """
+        Process the pending events, each in a transaction of its own so that
+        a failing notification does not hold back the others. An event is
+        retried till it has failed :py:attr:`max_attempts` times.
+
+        Each event is claimed (see :py:meth:`_claim`) before its comment is
+        notified, so that concurrent workers do not notify it twice.
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        events = cls.search([('state', '=', 'pending')])
+        if backend.name() == 'sqlite':
+            # SQLite has no concurrent transactions (and an in-memory
+            # database is not seen by a new cursor)
+            for event_id in map(int, events):
+                if not cls._claim(event_id):
+                    continue
+                try:
+                    cls.process([cls(event_id)])
+                except Exception:
+                    logger.exception(
+                        'Comment event %s could not be processed', event_id
+                    )
+                    cls._record_failure(event_id)
+            return
+
+        for event_id in map(int, events):
+            with Transaction().new_cursor() as transaction:
+                try:
+                    claimed = cls._claim(event_id)
+                except DatabaseOperationalError:
+                    # Another worker claimed the event and committed
+                    claimed = False
+                if not claimed:
+                    transaction.cursor.rollback()
+                    continue
+
+                try:
+                    cls.process([cls(event_id)])
+                except Exception:
+                    transaction.cursor.rollback()
+                    logger.exception(
+                        'Comment event %s could not be processed', event_id
+                    )
+                else:
+                    transaction.cursor.commit()
+                    continue
+
+            with Transaction().new_cursor() as transaction:
+                cls._record_failure(event_id)
+                transaction.cursor.commit()
+
+    @classmethod
+    def _claim(cls, event_id):
+        """
+        Claim the event for the worker of the current transaction, if it is
+        still pending (compare-and-swap). Return True if the event was
+        claimed and False if another worker already processed it.
+
+        The event row stays locked till the end of the transaction. A
+        concurrent worker claiming it waits for this transaction and,
+        since Tryton runs transactions at the REPEATABLE READ isolation
+        level, fails with a `DatabaseOperationalError` once it commits.
+        If the notification fails the transaction is rolled back and the
+        event is pending again.
+        """
+        transaction = Transaction()
+        cursor = transaction.cursor
+        event = cls.__table__()
+
+        cursor.execute(*event.update(
+            columns=[event.state, event.write_uid, event.write_date],
+            values=['done', transaction.user, CurrentTimestamp()],
+            where=(event.id == event_id) & (event.state == 'pending')
+        ))
+        return cursor.rowcount == 1
+
+    @classmethod
+    def _record_failure(cls, event_id):
+        """
+        Count a failed attempt to process the event, which is marked failed
+        after :py:attr:`max_attempts` attempts
+        """
+        event = cls(event_id)
+        attempts = event.attempts + 1
+        cls.write([event], {
+            'attempts': attempts,
+            'state': (
+                'failed' if attempts >= cls.max_attempts else 'pending'
+            ),
+        })
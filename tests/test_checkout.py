@@ -6,10 +6,14 @@
     :copyright: (c) 2010-2015 by Openlabs Technologies & Consulting (P) Ltd.
     :license: GPLv3, see LICENSE for more details
 '''
+import os
+import shutil
+import tempfile
 import unittest
 from ast import literal_eval
 from mock import patch
 from decimal import Decimal
+from email import message_from_string
 from datetime import date
 
 import trytond.tests.test_tryton
@@ -18,6 +22,7 @@ from trytond.config import config
 from trytond.transaction import Transaction
 from nereid import current_user
 from trytond import backend
+from jinja2 import Environment, DictLoader
 
 from trytond.modules.nereid_cart_b2c.tests.test_product import BaseTestCase
 
@@ -51,9 +56,11 @@ class BaseTestCheckout(BaseTestCase):
             'emails/sale-confirmation-text.jinja': ' ',
             'emails/sale-confirmation-html.jinja': ' ',
             'checkout.jinja': '{{form.errors|safe}}',
-            'sale.jinja': ' ',
+            'sale.jinja': '{{ order_fragment or "" }}',
+            'sale-fragment.jinja': '{{ sale.reference }}',
             'sales.jinja': '''{{request.args.get('filter_by')}}
                 {% for sale in sales %}#{{sale.id}}{% endfor %}
+                {% if sales.next_cursor %}[{{sales.next_cursor}}]{% endif %}
             '''
         })
 
@@ -1486,6 +1493,402 @@ class TestSale(BaseTestCheckout):
                     # Test if json-ld is successfully generated for Sale
                     self.assert_(sale.as_json_ld())
 
+                    # The batched version gives the same markup
+                    self.assertEqual(
+                        Sale.get_json_ld([sale]), [sale.as_json_ld()]
+                    )
+
+    def test_0015_sale_json_ld_snapshot(self):
+        """
+        The json-ld is stored when the sale is confirmed and cleared when
+        the lines are modified afterwards
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            Sale = POOL.get('sale.sale')
+            SaleLine = POOL.get('sale.line')
+
+            party = self.registered_user.party
+
+            with Transaction().set_context(company=self.company.id):
+                sale, = Sale.create([{
+                    'reference': 'Sale1',
+                    'sale_date': date.today(),
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                    'party': party.id,
+                    'lines': [
+                        ('create', [{
+                            'type': 'line',
+                            'quantity': 2,
+                            'unit': self.uom,
+                            'unit_price': 200,
+                            'description': 'Test description1',
+                            'product': self.product.id,
+                        }])
+                    ]}])
+
+                with app.test_request_context('/'):
+                    json_ld = sale.as_json_ld()
+                    Sale.quote([sale])
+                    Sale.confirm([sale])
+
+                    sale = Sale(sale.id)
+                    self.assertTrue(sale.json_ld)
+                    self.assertEqual(sale.as_json_ld(), json_ld)
+
+                    SaleLine.write(list(sale.lines), {'quantity': 3})
+                    sale = Sale(sale.id)
+                    self.assertFalse(sale.json_ld)
+                    self.assertEqual(
+                        sale.as_json_ld()['price'], str(sale.total_amount)
+                    )
+
+    def test_0016_email_templates_prepared_once(self):
+        """
+        The email templates are compiled once per environment, the helpers
+        of their context are shared and only they are bytecode cached
+        """
+        from trytond.modules.nereid_checkout.sale import \
+            prepare_email_templates, EMAIL_TEMPLATES, EMAIL_TEMPLATE_HELPERS
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            Sale = POOL.get('sale.sale')
+
+            party = self.registered_user.party
+            with Transaction().set_context(company=self.company.id):
+                sale1, sale2 = Sale.create([{
+                    'reference': 'Sale%d' % i,
+                    'sale_date': date.today(),
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                    'party': party.id,
+                } for i in range(2)])
+
+            templates = dict.fromkeys(EMAIL_TEMPLATES, 'Email')
+            templates['page.jinja'] = 'Page'
+            env = Environment(loader=DictLoader(templates))
+            cache_dir = tempfile.mkdtemp()
+            try:
+                with patch.object(
+                    env, 'get_template', wraps=env.get_template
+                ) as get_template, patch.object(
+                    config, 'get', return_value=cache_dir
+                ):
+                    prepare_email_templates(env)
+                    prepare_email_templates(env)
+                    self.assertEqual(
+                        get_template.call_count, len(EMAIL_TEMPLATES)
+                    )
+
+                # Only the email templates are cached in the directory
+                self.assertEqual(
+                    len(os.listdir(cache_dir)), len(EMAIL_TEMPLATES)
+                )
+                env.get_template('page.jinja')
+                self.assertEqual(
+                    len(os.listdir(cache_dir)), len(EMAIL_TEMPLATES)
+                )
+            finally:
+                shutil.rmtree(cache_dir)
+
+            with app.test_request_context('/'):
+                context1 = sale1._get_email_template_context()
+                context2 = sale2._get_email_template_context()
+            for name, helper in EMAIL_TEMPLATE_HELPERS.iteritems():
+                self.assertIs(context1[name], helper)
+                self.assertIs(context2[name], helper)
+
+    def test_0017_resend_confirmation_emails(self):
+        """
+        Re-send the confirmation emails of sales in bulk
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            Sale = POOL.get('sale.sale')
+            EmailQueue = POOL.get('email.queue')
+
+            party = self.registered_user.party
+            # A party without an email gets no email
+            party2, = self.Party.create([{
+                'name': 'No Email',
+                'addresses': [('create', [{'name': 'No Email'}])],
+            }])
+
+            with Transaction().set_context(company=self.company.id):
+                sales = Sale.create([{
+                    'reference': 'Sale%d' % i,
+                    'sale_date': date.today(),
+                    'invoice_address': p.addresses[0].id,
+                    'shipment_address': p.addresses[0].id,
+                    'state': 'confirmed',  # For testing purpose.
+                    'party': p.id,
+                } for i, p in enumerate([party, party, party, party2])])
+
+            progress = []
+            before = EmailQueue.search([], count=True)
+            operator = self.registered_user2
+            with app.test_request_context('/'), patch(
+                'trytond.modules.nereid_checkout.sale.current_user', operator
+            ):
+                # Run by a logged in user, who must not get the emails
+                with patch.object(
+                    EmailQueue, 'create', wraps=EmailQueue.create
+                ) as create:
+                    queued = Sale.resend_confirmation_emails(
+                        [('id', 'in', map(int, sales))], chunk_size=2,
+                        progress=lambda *args: progress.append(args[:3])
+                    )
+                    # A single insert per chunk
+                    self.assertEqual(create.call_count, 2)
+
+            self.assertEqual(queued, 3)
+            self.assertEqual(EmailQueue.search([], count=True), before + 3)
+            self.assertEqual(progress, [(2, 4, 2), (4, 4, 3)])
+            resent = EmailQueue.search([], order=[('id', 'DESC')], limit=3)
+            for email in resent:
+                self.assertEqual(email.to_addrs, party.email.lower())
+
+            # The email sent on confirmation is built the same way
+            with app.test_request_context('/'):
+                sales[2].send_confirmation_email()
+            email, = EmailQueue.search([], order=[('id', 'DESC')], limit=1)
+            self.assertEqual(
+                message_from_string(email.msg)['Subject'],
+                message_from_string(resent[0].msg)['Subject']
+            )
+            self.assertEqual(email.to_addrs, resent[0].to_addrs)
+
+            # The receivers are resolved in bulk and memoized per party
+            ContactMechanism = POOL.get('party.contact_mechanism')
+            memo = {}
+            receivers = Sale.get_receiver_email_addresses(sales, memo=memo)
+            self.assertEqual(memo.keys(), [party.id])
+            self.assertEqual(
+                receivers[sales[0].id], [party.email.lower()]
+            )
+            self.assertEqual(
+                sales[1]._get_receiver_email_address(),
+                receivers[sales[1].id]
+            )
+            with patch.object(ContactMechanism, 'search') as search:
+                Sale.get_receiver_email_addresses(sales, memo=memo)
+                self.assertFalse(search.called)
+
+    def _create_draft_sales(self, count):
+        """
+        Create draft sales without references for the registered user
+        """
+        Sale = POOL.get('sale.sale')
+
+        party = self.registered_user.party
+        with Transaction().set_context(company=self.company.id):
+            return Sale.create([{
+                'sale_date': date.today(),
+                'invoice_address': party.addresses[0].id,
+                'shipment_address': party.addresses[0].id,
+                'party': party.id,
+            } for i in range(count)])
+
+    def _get_number_next(self, sequence):
+        """
+        Read the next number of the sequence from the database
+        """
+        Transaction().cursor.cache.clear()
+        return sequence.__class__(sequence.id).number_next_internal
+
+    def test_0018_sale_reference_blocks(self):
+        """
+        References are drawn from blocks reserved by the process when the
+        sale configuration has a block size
+        """
+        from trytond.modules.nereid_checkout.sale import ReferenceAllocator
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            Sale = POOL.get('sale.sale')
+            Sequence = POOL.get('ir.sequence')
+            Configuration = POOL.get('sale.configuration')
+
+            config = Configuration(1)
+            Configuration.write([config], {'sale_reference_block_size': 3})
+            sequence = config.sale_sequence
+
+            allocator = ReferenceAllocator()
+            with patch(
+                'trytond.modules.nereid_checkout.sale.reference_allocator',
+                allocator
+            ):
+                number_next = self._get_number_next(sequence)
+                sales = self._create_draft_sales(2)
+                Sale.set_reference(sales)
+
+                # One block of 3 was reserved, one number is left
+                self.assertEqual(
+                    self._get_number_next(sequence), number_next + 3
+                )
+                references = [Sale(sale.id).reference for sale in sales]
+                self.assertEqual(len(set(references)), 2)
+
+                # The prefix is applied when the reference is handed out,
+                # and the block is dropped as the sequence was modified
+                Sequence.write([sequence], {'prefix': '${year}/'})
+                sale, = self._create_draft_sales(1)
+                Sale.set_reference([sale])
+                self.assertTrue(Sale(sale.id).reference.startswith(
+                    '%s/' % date.today().year
+                ))
+                self.assertEqual(
+                    self._get_number_next(sequence), number_next + 6
+                )
+
+                # A new block size drops the block too
+                Configuration.write([config], {'sale_reference_block_size': 2})
+                sale, = self._create_draft_sales(1)
+                Sale.set_reference([sale])
+                self.assertEqual(
+                    self._get_number_next(sequence), number_next + 8
+                )
+
+    def test_0019_resend_emails_script(self):
+        """
+        The command line interface passes its arguments to
+        resend_confirmation_emails and reports the progress
+        """
+        from StringIO import StringIO
+        from trytond.modules.nereid_checkout import resend_emails
+
+        app = resend_emails.load_app('trytond.transaction:Transaction')
+        self.assertIs(app, Transaction)
+
+        with patch.object(resend_emails, 'load_app') as load_app, \
+                patch.object(resend_emails, 'Transaction'), \
+                patch.object(resend_emails, 'Pool') as Pool, \
+                patch('sys.stdout', new_callable=StringIO) as stdout:
+            Sale = Pool.return_value.get.return_value
+            Sale.resend_confirmation_emails.return_value = 3
+
+            resend_emails.main([
+                'myproject:app', "[('state', '=', 'done')]",
+                '--chunk-size', '50',
+            ])
+
+            load_app.assert_called_once_with('myproject:app')
+            Pool.return_value.get.assert_called_once_with('sale.sale')
+            Sale.resend_confirmation_emails.assert_called_once_with(
+                [('state', '=', 'done')], chunk_size=50,
+                progress=resend_emails.report
+            )
+            self.assertEqual(stdout.getvalue(), '3 emails queued\n')
+
+            stdout.truncate(0)
+            resend_emails.report(50, 100, 40, 2.0)
+            self.assertEqual(
+                stdout.getvalue(),
+                '50/100 sales, 40 emails queued, 25.0 sales/s\n'
+            )
+
+    @unittest.skipIf(
+        backend.name() != 'postgresql', 'Query plans are checked on postgres'
+    )
+    def test_0020_orders_listing_index(self):
+        """
+        The query of the orders listing should be able to use the composite
+        index on (party, state, sale_date)
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            Sale = POOL.get('sale.sale')
+
+            # The query is built from the domain of the listing itself
+            with app.test_request_context('/'), patch(
+                'trytond.modules.nereid_checkout.sale.request'
+            ) as request:
+                request.nereid_user = self.registered_user
+                query = Sale.search(
+                    Sale._get_orders_domain(),
+                    order=[('sale_date', 'DESC'), ('id', 'DESC')],
+                    query=True
+                )
+            sql, params = query
+
+            cursor = Transaction().cursor
+            # The test database is too small for the planner to prefer an
+            # index over a sequential scan
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = [row[0] for row in cursor.fetchall()]
+
+            self.assertIn(
+                'sale_sale_party_state_sale_date_index', '\n'.join(plan)
+            )
+            # The range of sale dates is looked up in the index too, which
+            # the index on the party alone cannot do
+            self.assertTrue(any(
+                'Index Cond' in line and 'sale_date' in line for line in plan
+            ))
+
+    @unittest.skipIf(
+        backend.name() != 'postgresql',
+        'Blocks are reserved in a transaction of their own on postgres'
+    )
+    def test_0021_sale_reference_blocks_committed(self):
+        """
+        The block is reserved and committed in a transaction of its own, so
+        the sequence is not held by the transaction using the reference
+        """
+        from trytond.modules.nereid_checkout.sale import ReferenceAllocator
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            Sale = POOL.get('sale.sale')
+            Sequence = POOL.get('ir.sequence')
+            Configuration = POOL.get('sale.configuration')
+
+            config = Configuration(1)
+            Configuration.write([config], {'sale_reference_block_size': 3})
+            sequence = config.sale_sequence
+            table = Sequence.__table__()
+
+            def committed_number_next():
+                with Transaction().new_cursor() as transaction:
+                    transaction.cursor.execute(*table.select(
+                        table.number_next_internal,
+                        where=table.id == sequence.id
+                    ))
+                    number_next, = transaction.cursor.fetchone()
+                    transaction.cursor.rollback()
+                return number_next
+
+            allocator = ReferenceAllocator()
+            with patch(
+                'trytond.modules.nereid_checkout.sale.reference_allocator',
+                allocator
+            ):
+                number_next = committed_number_next()
+                sales = self._create_draft_sales(2)
+                Sale.set_reference(sales)
+
+                # Visible to other transactions before this one commits
+                self.assertEqual(committed_number_next(), number_next + 3)
+
+                # The transaction using the references holds no lock on
+                # the sequence: another process can reserve right away
+                numbers = ReferenceAllocator()._reserve(sequence, 2)
+                self.assertEqual(numbers, [number_next + 3, number_next + 4])
+                self.assertEqual(committed_number_next(), number_next + 5)
+
 
 def suite():
     "Checkout test suite"
@@ -11,13 +11,16 @@ import random
 from ast import literal_eval
 from decimal import Decimal
 import json
-from datetime import date
+from datetime import date, datetime
+from mock import patch
 from werkzeug.datastructures import Headers
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from trytond.config import config
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond import backend
 from nereid import current_user
 
 from test_checkout import BaseTestCheckout
@@ -544,6 +547,157 @@ class TestCheckoutPayment(BaseTestCheckout):
                 self.assertEqual(payment_transaction.amount, sale.total_amount)
                 self.assertEqual(payment_transaction.state, 'completed')
 
+    def test_0115_split_payment_across_methods(self):
+        "Split the payment of an order across alternate payment methods"
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            Sale = POOL.get('sale.sale')
+            PaymentMethod = POOL.get('nereid.website.payment_method')
+            Profile = POOL.get('party.payment_profile')
+
+            cheque_method = self._create_cheque_payment_method()
+            gift_card_method, = PaymentMethod.copy([cheque_method], {
+                'name': 'Gift Card',
+            })
+
+            with app.test_client() as c:
+                self._create_guest_order(c, quantity=10)
+
+            sale, = Sale.search([('state', '=', 'draft')])
+            amount = sale._get_amount_to_checkout()
+
+            with app.test_request_context('/checkout/payment'):
+                self.assertRaises(
+                    UserError, sale._add_sale_payments, [
+                        (gift_card_method, Decimal('30')),
+                        (cheque_method, amount),
+                    ]
+                )
+                self.assertRaises(
+                    UserError, sale._add_sale_payments, [
+                        (gift_card_method, Decimal('0')),
+                    ]
+                )
+                self.assertEqual(len(sale.payments), 0)
+
+                # The profile of another customer cannot be used
+                gateway = self._create_auth_net_gateway_for_site()
+                party = self.registered_user.party
+                profile, = Profile.create([{
+                    'last_4_digits': '1111',
+                    'sequence': '10',
+                    'expiry_month': '01',
+                    'expiry_year': '2018',
+                    'address': party.addresses[0].id,
+                    'party': party.id,
+                    'provider_reference': '26037832',
+                    'gateway': gateway.id,
+                    'authorize_profile_id': '28545177',
+                }])
+                self.assertRaises(
+                    UserError, sale._add_sale_payments, [
+                        (profile, Decimal('30')),
+                    ]
+                )
+                self.assertEqual(len(Sale(sale.id).payments), 0)
+
+                # Stub the gateway: the gift card leg is declined
+                with patch.object(Sale, 'authorize_payments'), \
+                        patch.object(
+                            Sale, '_get_authorized_amount',
+                            side_effect=lambda payment: (
+                                0 if payment.amount == Decimal('30')
+                                else payment.amount
+                            )
+                        ):
+                    self.assertRaises(
+                        UserError, sale._add_sale_payments, [
+                            (gift_card_method, Decimal('30')),
+                            (cheque_method, amount - Decimal('30')),
+                        ]
+                    )
+
+                # None of the payments of the failed batch is kept
+                self.assertEqual(len(Sale(sale.id).payments), 0)
+
+            with app.test_request_context('/checkout/payment'), \
+                    patch.object(Sale, 'authorize_payments') as authorize, \
+                    patch.object(
+                        Sale, '_get_authorized_amount',
+                        side_effect=lambda payment: payment.amount
+                    ):
+                payments = Sale(sale.id)._add_sale_payments([
+                    (gift_card_method, Decimal('30')),
+                    (cheque_method, amount - Decimal('30')),
+                ])
+                authorize.assert_called_once_with(amount)
+
+            self.assertEqual(len(payments), 2)
+            self.assertEqual(
+                sorted(p.amount for p in Sale(sale.id).payments),
+                sorted([Decimal('30'), amount - Decimal('30')])
+            )
+
+    def test_0117_payment_method_eligibility_rules(self):
+        "Alternate payment methods are filtered by their eligibility rules"
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            Sale = POOL.get('sale.sale')
+            PaymentMethod = POOL.get('nereid.website.payment_method')
+            Rule = POOL.get('nereid.website.payment_method.rule')
+
+            cheque_method = self._create_cheque_payment_method()
+            cod_method, = PaymentMethod.copy([cheque_method], {
+                'name': 'Cash on Delivery',
+            })
+
+            with app.test_client() as c:
+                self._create_guest_order(c, quantity=10)
+
+            sale, = Sale.search([('state', '=', 'draft')])
+            methods = [cheque_method, cod_method]
+
+            self.assertEqual(
+                PaymentMethod.filter_eligible(methods, sale, 'guest'),
+                methods
+            )
+
+            # COD only below the sale amount
+            rule, = Rule.create([{
+                'payment_method': cod_method.id,
+                'max_amount': sale.total_amount - 1,
+            }])
+            self.assertEqual(
+                PaymentMethod.filter_eligible(methods, sale, 'guest'),
+                [cheque_method]
+            )
+
+            # Any one of the rules could match
+            Rule.create([{
+                'payment_method': cod_method.id,
+                'customer_type': 'guest',
+                'country': sale.shipment_address.country.id,
+                'currency': sale.currency.id,
+            }])
+            self.assertEqual(
+                PaymentMethod.filter_eligible(methods, sale, 'guest'),
+                methods
+            )
+            self.assertEqual(
+                PaymentMethod.filter_eligible(methods, sale, 'registered'),
+                [cheque_method]
+            )
+
+            Rule.write([rule], {'max_amount': None})
+            self.assertEqual(
+                PaymentMethod.filter_eligible(methods, sale, 'registered'),
+                methods
+            )
+
     def test_0120_guest_profile_fail(self):
         "Guest - Fucks with profile"
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
@@ -900,6 +1054,181 @@ class TestCheckoutPayment(BaseTestCheckout):
                 sale, = self.Sale.search([('state', '=', 'confirmed')])
                 self.assertEqual(sale.invoice_address.id, address.id)
 
+    def test_0232_pre_authorize_payment_profile(self):
+        """
+        Pre-authorize a payment profile from the payment page and confirm
+        the order without authorizing again.
+        """
+        Profile = POOL.get('party.payment_profile')
+        NereidWebsite = POOL.get('nereid.website')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            party = self.registered_user.party
+            gateway = self._create_auth_net_gateway_for_site()
+            profile, = Profile.create([{
+                'last_4_digits': '1111',
+                'sequence': '10',
+                'expiry_month': '01',
+                'expiry_year': '2018',
+                'address': party.addresses[0].id,
+                'party': party.id,
+                'provider_reference': '26037832',
+                'gateway': gateway.id,
+                'authorize_profile_id': '28545177',
+            }])
+
+            with app.test_client() as c:
+                self._create_regd_user_order(c, quantity=10)
+
+                # Not available unless enabled on the website
+                rv = c.post(
+                    '/checkout/payment/pre-authorize',
+                    data={'payment_profile': profile.id}
+                )
+                self.assertEqual(rv.status_code, 404)
+
+                NereidWebsite.write(NereidWebsite.search([]), {
+                    'pre_authorize_payment_profiles': True,
+                })
+
+                # Stub the gateway authorization, first declined
+                Sale = POOL.get('sale.sale')
+                SaleLine = POOL.get('sale.line')
+                with patch.object(Sale, 'authorize_payments'), \
+                        patch.object(
+                            Sale, '_get_authorized_amount', return_value=0
+                        ):
+                    rv = c.post(
+                        '/checkout/payment/pre-authorize',
+                        data={'payment_profile': profile.id}
+                    )
+                    self.assertEqual(rv.status_code, 402)
+                    self.assertFalse(json.loads(rv.data)['success'])
+
+                    # The declined payment is not left on the sale
+                    sale, = self.Sale.search([('state', '=', 'draft')])
+                    self.assertEqual(len(sale.payments), 0)
+
+                # The errors of the gateway are returned as JSON too
+                with patch.object(
+                    Sale, 'authorize_payments',
+                    side_effect=UserError('Gateway unavailable')
+                ):
+                    rv = c.post(
+                        '/checkout/payment/pre-authorize',
+                        data={'payment_profile': profile.id},
+                        headers=[('X-Requested-With', 'XMLHttpRequest')]
+                    )
+                    self.assertEqual(rv.status_code, 402)
+                    self.assertEqual(
+                        json.loads(rv.data)['message'], 'Gateway unavailable'
+                    )
+                    self.assertEqual(len(self.Sale(sale.id).payments), 0)
+                    with c.session_transaction() as sess:
+                        self.assertFalse(sess.get('_flashes'))
+
+                with patch.object(
+                    Sale, 'authorize_payments'
+                ) as authorize_payments, patch.object(
+                    Sale, '_get_authorized_amount',
+                    side_effect=lambda payment: payment.amount
+                ):
+                    rv = c.post(
+                        '/checkout/payment/pre-authorize',
+                        data={'payment_profile': profile.id}
+                    )
+                    self.assertEqual(rv.status_code, 200)
+                    self.assertTrue(json.loads(rv.data)['success'])
+                    self.assertEqual(authorize_payments.call_count, 1)
+
+                    sale, = self.Sale.search([('state', '=', 'draft')])
+                    payment, = sale.payments
+                    self.assertEqual(payment.payment_profile, profile)
+                    self.assertEqual(payment.amount, sale.total_amount)
+                    self.assertTrue(payment.pre_authorization)
+
+                    # Selecting the same profile again is a no-op
+                    rv = c.post(
+                        '/checkout/payment/pre-authorize',
+                        data={'payment_profile': profile.id}
+                    )
+                    self.assertEqual(rv.status_code, 200)
+                    self.assertEqual(authorize_payments.call_count, 1)
+
+                    # The amount changes, the authorization is voided and
+                    # done again for the new amount
+                    SaleLine.write(
+                        [line for line in sale.lines if line.type == 'line'],
+                        {'quantity': 20}
+                    )
+                    rv = c.post(
+                        '/checkout/payment/pre-authorize',
+                        data={'payment_profile': profile.id}
+                    )
+                    self.assertEqual(rv.status_code, 200)
+                    self.assertEqual(authorize_payments.call_count, 2)
+
+                    sale = self.Sale(sale.id)
+                    new_payment, = sale.payments
+                    self.assertNotEqual(new_payment.id, payment.id)
+                    self.assertEqual(new_payment.amount, sale.total_amount)
+
+                    rv = c.post(
+                        '/checkout/payment',
+                        data={'payment_profile': profile.id}
+                    )
+                    self.assertEqual(rv.status_code, 302)
+                    self.assertTrue('/order/' in rv.location)
+
+                sale, = self.Sale.search([('state', '=', 'confirmed')])
+                self.assertEqual(len(sale.payments), 1)
+
+    def test_0235_payment_profile_summaries_cache(self):
+        """
+        The cached payment profile summaries must be invalidated when
+        profiles are created, modified or deleted.
+        """
+        Profile = POOL.get('party.payment_profile')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            party = self.registered_user.party
+            gateway = self._create_auth_net_gateway_for_site()
+
+            self.assertEqual(party.get_payment_profile_summaries(), [])
+
+            profile, = Profile.create([{
+                'last_4_digits': '1111',
+                'sequence': '10',
+                'expiry_month': '01',
+                'expiry_year': '2018',
+                'address': party.addresses[0].id,
+                'party': party.id,
+                'provider_reference': '26037832',
+                'gateway': gateway.id,
+                'authorize_profile_id': '28545177',
+            }])
+
+            summary, = party.get_payment_profile_summaries()
+            self.assertEqual(summary['id'], profile.id)
+            self.assertEqual(summary['address'], party.addresses[0].id)
+            self.assertEqual(summary['expiry_year'], '2018')
+            self.assertEqual(party.get_payment_profiles(), [profile])
+            self.assertEqual(
+                party.get_payment_profile_summaries(method='manual'), []
+            )
+
+            Profile.write([profile], {'expiry_year': '2020'})
+            summary, = party.get_payment_profile_summaries()
+            self.assertEqual(summary['expiry_year'], '2020')
+
+            Profile.delete([profile])
+            self.assertEqual(party.get_payment_profile_summaries(), [])
+
     def test_0240_add_comment_to_sale(self):
         """
         Add comment to sale for logged in user.
@@ -974,10 +1303,15 @@ class TestCheckoutPayment(BaseTestCheckout):
                     }, headers=[('X-Requested-With', 'XMLHttpRequest')]
                 )
 
-                json_data = json.loads(rv.data)['message']
-                self.assertEqual('Comment Added', json_data)
+                json_data = json.loads(rv.data)
+                self.assertEqual('Comment Added', json_data['message'])
+                self.assertEqual(
+                    'This is comment on sale!', json_data['comment']['comment']
+                )
 
-                self.assertEqual('This is comment on sale!', sale.comment)
+                comment, = sale.comments
+                self.assertEqual('This is comment on sale!', comment.comment)
+                self.assertEqual(comment.nereid_user, current_user)
 
                 rv = c.post(
                     '/order/%s/add-comment' % (sale.id,), data={
@@ -986,6 +1320,28 @@ class TestCheckoutPayment(BaseTestCheckout):
                 )
                 self.assertTrue(rv.status_code, 302)
 
+                # Comments are appended, the sale is not written
+                sale = self.Sale(sale.id)
+                self.assertEqual(
+                    [record.comment for record in sale.comments],
+                    ['This is comment on sale!', 'This is comment!']
+                )
+                self.assertIsNone(sale.comment)
+
+                rv = c.get('/order/%s/comments' % sale.id)
+                json_data = json.loads(rv.data)
+                self.assertEqual(json_data['count'], 2)
+                self.assertEqual(
+                    json_data['comments'][1]['comment'], 'This is comment!'
+                )
+
+                with self.assertRaises(UserError):
+                    comment.__class__.write([comment], {'comment': 'Edit'})
+
+            # The comments are shown on the sale in the back office
+            view = self.Sale.fields_view_get(view_type='form')
+            self.assertIn('comments', view['fields'])
+
     def test_0245_no_comment_on_cancelled_sale(self):
         """
         Trying to comment on a cancelled sale should return 403.
@@ -1069,7 +1425,82 @@ class TestCheckoutPayment(BaseTestCheckout):
                 json_data = json.loads(rv.data)['message']
                 self.assertEqual('Comment Added', json_data)
 
-                self.assertEqual('This is comment on sale!', sale.comment)
+                comment, = sale.comments
+                self.assertEqual('This is comment on sale!', comment.comment)
+                self.assertIsNone(comment.nereid_user)
+
+            # The notification is queued and left to the worker
+            Event = POOL.get('sale.sale.comment.event')
+            event, = Event.search([('comment', '=', comment.id)])
+            self.assertEqual(event.state, 'pending')
+
+            SaleComment = POOL.get('sale.sale.comment')
+            with patch.object(SaleComment, 'notify') as notify:
+                Event.process([event])
+                self.assertEqual(notify.call_count, 1)
+
+            self.assertEqual(Event(event.id).state, 'done')
+
+            # A processed event cannot be claimed by another worker
+            self.assertFalse(Event._claim(event.id))
+
+    @unittest.skipIf(
+        backend.name() != 'sqlite',
+        'Events are processed in transactions of their own on postgres'
+    )
+    def test_0255_process_comment_events(self):
+        """
+        The worker notifies each pending event once and retries the failed
+        ones till they have failed max_attempts times
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            Sale = POOL.get('sale.sale')
+            SaleComment = POOL.get('sale.sale.comment')
+            Event = POOL.get('sale.sale.comment.event')
+
+            party = self.registered_user.party
+            with Transaction().set_context(company=self.company.id):
+                sale, = Sale.create([{
+                    'reference': 'Sale1',
+                    'sale_date': date.today(),
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                    'state': 'confirmed',  # For testing purpose.
+                    'party': party.id,
+                }])
+            comment1, comment2 = SaleComment.create([{
+                'sale': sale.id,
+                'comment': comment,
+            } for comment in ('Comment 1', 'Comment 2')])
+            event1, = Event.search([('comment', '=', comment1.id)])
+            event2, = Event.search([('comment', '=', comment2.id)])
+
+            def notify(comment):
+                if comment.id == comment2.id:
+                    raise Exception('Notification failed')
+
+            with patch.object(
+                SaleComment, 'notify', autospec=True, side_effect=notify
+            ) as mock:
+                Event.process_all()
+                self.assertEqual(mock.call_count, 2)
+
+                self.assertEqual(Event(event1.id).state, 'done')
+                self.assertEqual(Event(event2.id).state, 'pending')
+                self.assertEqual(Event(event2.id).attempts, 1)
+
+                # Only the failed event is retried, till it is marked failed
+                for attempt in range(Event.max_attempts - 1):
+                    Event.process_all()
+                self.assertEqual(mock.call_count, 1 + Event.max_attempts)
+                self.assertEqual(Event(event2.id).state, 'failed')
+                self.assertEqual(Event(event2.id).attempts, Event.max_attempts)
+
+                # Failed events are left alone
+                Event.process_all()
+                self.assertEqual(mock.call_count, 1 + Event.max_attempts)
 
     def test_0300_access_order_page(self):
         """
@@ -1119,6 +1550,258 @@ class TestCheckoutPayment(BaseTestCheckout):
                 )
                 self.assertEqual(rv.status_code, 200)
 
+                rv = c.get('/order/access/%s' % sale.guest_access_code)
+                self.assertEqual(rv.status_code, 200)
+
+                # Conditional GET
+                rv = c.get(
+                    '/order/%s?access_code=%s' % (
+                        sale.id, sale.guest_access_code
+                    )
+                )
+                self.assertEqual(rv.status_code, 200)
+                etag = rv.headers['ETag']
+                self.assertTrue(rv.headers['Last-Modified'])
+
+                rv = c.get(
+                    '/order/%s?access_code=%s' % (
+                        sale.id, sale.guest_access_code
+                    ), headers=[('If-None-Match', etag)]
+                )
+                self.assertEqual(rv.status_code, 304)
+
+                rv = c.get(
+                    '/order/%s?access_code=%s' % (
+                        sale.id, sale.guest_access_code
+                    ), headers=[
+                        ('If-Modified-Since', rv.headers['Last-Modified'])
+                    ]
+                )
+                self.assertEqual(rv.status_code, 304)
+
+                # Order status
+                rv = c.get(
+                    '/order/%s/status?access_code=%s' % (
+                        sale.id, sale.guest_access_code
+                    )
+                )
+                self.assertEqual(rv.status_code, 200)
+                status = json.loads(rv.data)
+                self.assertEqual(status['state'], 'confirmed')
+                self.assertEqual(rv.headers['ETag'], '"%s"' % status['version'])
+
+                rv = c.get(
+                    '/order/%s/status?access_code=%s' % (
+                        sale.id, sale.guest_access_code
+                    ), headers=[('If-None-Match', rv.headers['ETag'])]
+                )
+                self.assertEqual(rv.status_code, 304)
+
+                # Long-poll: the clock advances a second per check and the
+                # rollback, which would undo the test data, is stubbed
+                status_url = '/order/%s/status?access_code=%s&wait=2' % (
+                    sale.id, sale.guest_access_code
+                )
+                version = '"%s"' % status['version']
+                cursor = Transaction().cursor
+                with patch(
+                    'trytond.modules.nereid_checkout.sale.time'
+                ) as time_, patch.object(cursor, 'rollback') as rollback:
+                    time_.time.side_effect = iter(xrange(100)).next
+
+                    # Nothing changes till the wait is over, and no
+                    # transaction is open while waiting
+                    time_.sleep.side_effect = lambda seconds: (
+                        self.assertEqual(rollback.call_count, 1)
+                    )
+                    rv = c.get(
+                        status_url, headers=[('If-None-Match', version)]
+                    )
+                    self.assertEqual(rv.status_code, 304)
+                    self.assertEqual(time_.sleep.call_count, 1)
+
+                    # The sale changes while the request is held
+                    time_.time.side_effect = iter(xrange(100)).next
+                    time_.sleep.side_effect = lambda seconds: Sale.write(
+                        [Sale(sale.id)], {'state': 'processing'}
+                    )
+                    rv = c.get(
+                        status_url, headers=[('If-None-Match', version)]
+                    )
+                    self.assertEqual(rv.status_code, 200)
+                    self.assertNotEqual(rv.headers['ETag'], version)
+
+                rv = c.get('/order/%s/status' % sale.id)
+                self.assertEqual(rv.status_code, 302)  # Redirect to login
+
+                # The conditional GET does not skip authorization
+                rv = c.get(
+                    '/order/%s?access_code=%s' % (
+                        sale.id, "wrong-access-code"
+                    ), headers=[('If-None-Match', etag)]
+                )
+                self.assertEqual(rv.status_code, 403)
+
+                rv = c.get('/order/access/%s' % "wrong-access-code")
+                self.assertEqual(rv.status_code, 404)
+
+            # The order fragment is cached once for all the sessions
+            url = '/order/%s?access_code=%s' % (
+                sale.id, sale.guest_access_code
+            )
+            with patch.object(Sale, 'cache_rendered_order', True), \
+                    patch.object(
+                        Sale._render_cache, 'set',
+                        wraps=Sale._render_cache.set
+                    ) as cache_set:
+                for index in range(2):
+                    with app.test_client() as c:
+                        rv = c.get(url)
+                        self.assertEqual(rv.status_code, 200)
+                        self.assertIn(sale.reference, rv.data)
+
+                key, fragment = cache_set.call_args[0]
+                self.assertEqual(cache_set.call_count, 1)
+                self.assertEqual(key[0], sale.id)
+                self.assertEqual(fragment, sale.reference)
+
+            # The page is rendered lazily, so that its context can still be
+            # changed by downstream modules
+            with app.test_request_context(url):
+                rv = Sale(sale.id).render()
+                self.assertEqual(rv.context['sale'], Sale(sale.id))
+                self.assertEqual(rv.context['order_fragment'], sale.reference)
+
+    def test_0303_orders_page_search(self):
+        """
+        Search the orders of the orders page by their search text
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            Sale = POOL.get('sale.sale')
+            Address = POOL.get('party.address')
+
+            party = self.registered_user.party
+
+            with Transaction().set_context(company=self.company.id):
+                sale1, sale2 = Sale.create([{
+                    'reference': reference,
+                    'sale_date': date.today(),
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                    'party': party.id,
+                    'lines': [
+                        ('create', [{
+                            'type': 'line',
+                            'quantity': 2,
+                            'unit': self.uom,
+                            'unit_price': 200,
+                            'description': 'Test description1',
+                            'product': self.product.id,
+                        }])
+                    ]} for reference in ('Sale1', 'Sale_2')])
+
+            # The search text is computed on confirmation
+            Sale.quote([sale1])
+            Sale.confirm([sale1])
+            search_text = Sale(sale1.id).search_text
+            self.assertIn('Sale1', search_text)
+            self.assertIn('Test Product', search_text)
+
+            # Orders which were confirmed without a search text are filled
+            # in by the backfill
+            Sale.write([sale2], {'state': 'done'})
+            self.assertIsNone(Sale(sale2.id).search_text)
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                rv = c.get('/orders?q=sale1')
+                self.assertIn('#{0}'.format(sale1.id), rv.data)
+                self.assertNotIn('#{0}'.format(sale2.id), rv.data)
+
+                rv = c.get('/orders?q=test+product')
+                self.assertIn('#{0}'.format(sale1.id), rv.data)
+
+                rv = c.get('/orders?q=nowhere')
+                self.assertNotIn('#{0}'.format(sale1.id), rv.data)
+
+                Sale.update_search_text()
+                rv = c.get('/orders?q=test+product')
+                self.assertIn('#{0}'.format(sale1.id), rv.data)
+                self.assertIn('#{0}'.format(sale2.id), rv.data)
+
+                # The search text follows the changes of the address
+                Address.write([party.addresses[0]], {'city': 'Timbuktu'})
+                rv = c.get('/orders?q=timbuktu')
+                self.assertIn('#{0}'.format(sale1.id), rv.data)
+                self.assertIn('#{0}'.format(sale2.id), rv.data)
+
+            if backend.name() != 'postgresql':
+                # The wildcards of the search are matched literally
+                self.assertEqual(
+                    Sale.search(Sale._get_search_domain('sale_')), [sale2]
+                )
+                self.assertEqual(
+                    Sale.search(Sale._get_search_domain('%')), []
+                )
+
+    def test_0304_orders_page_prefetch_queries(self):
+        """
+        The records rendered by the orders listing are read in a fixed
+        number of queries regardless of the number of orders on the page
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            Sale = POOL.get('sale.sale')
+
+            party = self.registered_user.party
+
+            with Transaction().set_context(company=self.company.id):
+                Sale.create([{
+                    'reference': 'Sale%d' % i,
+                    'sale_date': date.today(),
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                    'state': 'done',  # For testing purpose.
+                    'party': party.id,
+                    'lines': [
+                        ('create', [{
+                            'type': 'line',
+                            'quantity': 2,
+                            'unit': self.uom,
+                            'unit_price': 200,
+                            'description': 'Test description%d' % i,
+                            'product': self.product.id,
+                        }])
+                    ]} for i in range(8)])
+
+            cursor = Transaction().cursor
+
+            def count_queries(per_page):
+                sales = Sale.search(
+                    [('party', '=', party.id)], limit=per_page,
+                    order=[('id', 'ASC')]
+                )
+                self.assertEqual(len(sales), per_page)
+
+                # Read from the database, not from the records cache
+                cursor.cache.clear()
+                with patch.object(
+                    cursor, 'execute', wraps=cursor.execute
+                ) as execute:
+                    Sale._prefetch_for_listing(sales)
+                return execute.call_count
+
+            # Fill the caches of the access rights and rules first
+            count_queries(1)
+
+            self.assertTrue(count_queries(2))
+            self.assertEqual(count_queries(2), count_queries(8))
+
     def test_0305_orders_page_regd(self):
         """
         Accesses orders page for a registered user.
@@ -1216,6 +1899,272 @@ class TestCheckoutPayment(BaseTestCheckout):
                 self.assertNotIn('#{0}'.format(sale1.id), rv.data)
                 self.assertNotIn('#{0}'.format(sale2.id), rv.data)
 
+    @unittest.skipIf(
+        backend.name() != 'postgresql', 'Full text search is on postgres'
+    )
+    def test_0306_orders_full_text_search(self):
+        """
+        On PostgreSQL the orders are searched with the full text index of
+        their search text
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            Sale = POOL.get('sale.sale')
+
+            party = self.registered_user.party
+            with Transaction().set_context(company=self.company.id):
+                sale1, sale2 = Sale.create([{
+                    'reference': reference,
+                    'sale_date': date.today(),
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                    'state': 'confirmed',  # For testing purpose.
+                    'party': party.id,
+                } for reference in ('Blue Widget', 'Red Gadget')])
+            Sale.update_search_text([sale1, sale2])
+
+            self.assertEqual(
+                Sale.search(Sale._get_search_domain('widget blue')), [sale1]
+            )
+            self.assertEqual(
+                Sale.search(Sale._get_search_domain('gadget')), [sale2]
+            )
+            self.assertEqual(
+                Sale.search(Sale._get_search_domain('blue gadget')), []
+            )
+
+            # The search is served by the full text index
+            cursor = Transaction().cursor
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            query, params = Sale.search(
+                Sale._get_search_domain('widget'), query=True
+            )
+            cursor.execute('EXPLAIN ' + query, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            self.assertIn('sale_sale_search_text_fts_index', plan)
+
+    def test_0307_orders_page_keyset_pagination(self):
+        """
+        Paginate the orders page with cursors instead of page numbers
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            Sale = POOL.get('sale.sale')
+
+            party = self.registered_user.party
+
+            with Transaction().set_context(company=self.company.id):
+                sales = Sale.create([{
+                    'reference': 'Sale%d' % i,
+                    'sale_date': date.today(),
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                    'state': 'done',  # For testing purpose.
+                    'party': party.id,
+                } for i in range(3)])
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                with patch.object(Sale, 'per_page', 2):
+                    rv = c.get('/orders?filter_by=done&cursor=')
+                    self.assertEqual(rv.status_code, 200)
+                    self.assertIn('#{0}'.format(sales[2].id), rv.data)
+                    self.assertIn('#{0}'.format(sales[1].id), rv.data)
+                    self.assertNotIn('#{0}'.format(sales[0].id), rv.data)
+
+                    cursor = rv.data[rv.data.index('[') + 1:rv.data.index(']')]
+                    rv = c.get('/orders?filter_by=done&cursor=%s' % cursor)
+                    self.assertEqual(rv.status_code, 200)
+                    self.assertIn('#{0}'.format(sales[0].id), rv.data)
+                    self.assertNotIn('#{0}'.format(sales[1].id), rv.data)
+                    self.assertNotIn('[', rv.data)
+
+                    rv = c.get('/orders?filter_by=done&cursor=invalid')
+                    self.assertEqual(rv.status_code, 400)
+
+                    # Page numbers still work
+                    rv = c.get('/orders/2?filter_by=done')
+                    self.assertEqual(rv.status_code, 200)
+                    self.assertIn('#{0}'.format(sales[0].id), rv.data)
+
+    def test_0308_order_counts(self):
+        """
+        Order counts of each filter of the orders listing
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            Sale = POOL.get('sale.sale')
+
+            party = self.registered_user.party
+
+            with Transaction().set_context(company=self.company.id):
+                sale1, sale2, sale3 = Sale.create([{
+                    'reference': 'Sale1',
+                    'sale_date': date.today(),
+                    'party': party.id,
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                    'lines': [
+                        ('create', [{
+                            'type': 'line',
+                            'quantity': 2,
+                            'unit': self.uom,
+                            'unit_price': 200,
+                            'description': 'Test description1',
+                            'product': self.product.id,
+                        }])
+                    ]
+                }, {
+                    'reference': 'Sale2',
+                    'sale_date': date.today(),
+                    'party': party.id,
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                    'state': 'done',  # For testing purpose.
+                }, {
+                    'reference': 'Sale3',
+                    'sale_date': date(2014, 6, 6),
+                    'party': party.id,
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                }])
+
+            self.assertEqual(Sale.get_order_counts(party.id), {
+                'done': 1, 'canceled': 0, 'archived': 0, 'recent': 1,
+            })
+
+            Sale.quote([sale1])
+            Sale.confirm([sale1])
+            Sale.cancel([sale3])
+
+            self.assertEqual(Sale.get_order_counts(party.id), {
+                'done': 1, 'canceled': 1, 'archived': 1, 'recent': 2,
+            })
+
+            # The counts are kept per party: a transition only updates the
+            # counts of the party of the sale, with a single indexed read
+            SaleOrderCount = POOL.get('sale.sale.order_count')
+            party2 = self.registered_user2.party
+            with Transaction().set_context(company=self.company.id):
+                sale4, = Sale.create([{
+                    'reference': 'Sale4',
+                    'sale_date': date.today(),
+                    'party': party2.id,
+                    'invoice_address': party2.addresses[0].id,
+                    'shipment_address': party2.addresses[0].id,
+                    'state': 'done',  # For testing purpose.
+                }])
+            with patch.object(
+                SaleOrderCount, 'update_counts',
+                wraps=SaleOrderCount.update_counts
+            ) as update_counts:
+                Sale.write([sale4], {'state': 'cancel'})
+                old_keys, new_keys = update_counts.call_args[0]
+                self.assertEqual(
+                    set(key[0] for key in old_keys + new_keys),
+                    set([party2.id])
+                )
+
+            self.assertEqual(Sale.get_order_counts(party2.id), {
+                'done': 0, 'canceled': 1, 'archived': 0, 'recent': 0,
+            })
+            self.assertEqual(Sale.get_order_counts(party.id), {
+                'done': 1, 'canceled': 1, 'archived': 1, 'recent': 2,
+            })
+
+            # Writing other fields does not touch the counts
+            with patch.object(SaleOrderCount, 'update_counts') as update:
+                Sale.write([sale1], {'reference': 'Sale1-1'})
+                self.assertFalse(update.called)
+
+            Sale.delete([sale4])
+            self.assertEqual(Sale.get_order_counts(party2.id), {
+                'done': 0, 'canceled': 0, 'archived': 0, 'recent': 0,
+            })
+
+    def test_0309_export_orders(self):
+        """
+        Export the order history as CSV and newline delimited JSON
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            Sale = POOL.get('sale.sale')
+
+            party = self.registered_user.party
+
+            with Transaction().set_context(company=self.company.id):
+                Sale.create([{
+                    'reference': 'Sale%d' % i,
+                    'sale_date': date.today(),
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                    'state': 'done',  # For testing purpose.
+                    'party': party.id,
+                    'lines': [
+                        ('create', [{
+                            'type': 'line',
+                            'quantity': 2,
+                            'unit': self.uom,
+                            'unit_price': 200,
+                            'description': 'Test description%d' % i,
+                            'product': self.product.id,
+                        }])
+                    ]} for i in range(3)])
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                with patch.object(Sale, 'export_batch_size', 2):
+                    rv = c.get('/orders/export?filter_by=done')
+                    self.assertEqual(rv.status_code, 200)
+                    self.assertEqual(rv.mimetype, 'text/csv')
+                    rows = rv.data.splitlines()
+                    self.assertEqual(len(rows), 4)
+                    self.assertTrue(rows[0].startswith('Order,'))
+                    self.assertTrue(rows[1].startswith('Sale2,'))
+                    self.assertIn('Test description0', rows[3])
+
+                    rv = c.get('/orders/export?filter_by=done&format=ndjson')
+                    self.assertEqual(rv.status_code, 200)
+                    orders = map(json.loads, rv.data.splitlines())
+                    self.assertEqual(
+                        [o['reference'] for o in orders],
+                        ['Sale2', 'Sale1', 'Sale0']
+                    )
+                    self.assertEqual(orders[0]['lines'][0]['quantity'], 2)
+
+                    rv = c.get('/orders/export?format=xls')
+                    self.assertEqual(rv.status_code, 400)
+
+                # The whole history is exported by default, whatever the
+                # state and date of the orders, but the drafts
+                with Transaction().set_context(company=self.company.id):
+                    Sale.create([{
+                        'reference': reference,
+                        'sale_date': date(2014, 6, 6),
+                        'invoice_address': party.addresses[0].id,
+                        'shipment_address': party.addresses[0].id,
+                        'state': state,  # For testing purpose.
+                        'party': party.id,
+                    } for reference, state in [
+                        ('Old', 'cancel'), ('Draft', 'draft'),
+                    ]])
+
+                rv = c.get('/orders/export?format=ndjson')
+                self.assertEqual(rv.status_code, 200)
+                orders = map(json.loads, rv.data.splitlines())
+                self.assertEqual(
+                    [o['reference'] for o in orders],
+                    ['Sale2', 'Sale1', 'Sale0', 'Old']
+                )
+
     def test_0310_guest_user_payment_using_credit_card(self):
         """
         ===================================
@@ -1286,6 +2235,134 @@ class TestCheckoutPayment(BaseTestCheckout):
                 self.assertEqual(sale.payment_captured, Decimal('100'))
                 self.assertEqual(sale.payment_authorized, Decimal('0'))
 
+    def test_0311_bulk_fetch_orders(self):
+        """
+        Fetch summaries of several orders at once
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            Sale = POOL.get('sale.sale')
+
+            party = self.registered_user.party
+            party2 = self.registered_user2.party
+
+            with Transaction().set_context(company=self.company.id):
+                sale1, sale2, sale3 = Sale.create([{
+                    'reference': 'Sale%d' % i,
+                    'sale_date': date.today(),
+                    'invoice_address': p.addresses[0].id,
+                    'shipment_address': p.addresses[0].id,
+                    'party': p.id,
+                } for i, p in enumerate([party, party, party2])])
+
+            with app.test_client() as c:
+                # Guests need the access codes
+                rv = c.get('/orders/bulk?ids=%d' % sale1.id)
+                self.assertEqual(rv.status_code, 403)
+
+                rv = c.get('/orders/bulk?ids=%d,%d&access_codes=%s' % (
+                    sale1.id, sale2.id, sale2.guest_access_code
+                ))
+                orders = json.loads(rv.data)['orders']
+                self.assertEqual([o['id'] for o in orders], [sale2.id])
+
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+
+                rv = c.get(
+                    '/orders/bulk?ids=%d,%d&references=Sale1&fields=id,state'
+                    % (sale1.id, sale3.id)
+                )
+                self.assertEqual(rv.status_code, 200)
+                orders = json.loads(rv.data)['orders']
+                self.assertEqual(
+                    sorted(o['id'] for o in orders), [sale1.id, sale2.id]
+                )
+                self.assertEqual(set(orders[0]), set(['id', 'state']))
+
+                rv = c.get('/orders/bulk?ids=%d&fields=password' % sale1.id)
+                self.assertEqual(rv.status_code, 400)
+
+    def test_0315_confirm_cart_submitted_twice(self):
+        """
+        Only one submission of the payment page claims the sale, the other
+        is redirected to the order without writing the sale or adding a
+        payment to it
+        """
+        Sale = POOL.get('sale.sale')
+        Cart = POOL.get('nereid.cart')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        card = {
+            'owner': 'Joe Blow',
+            'number': '4111111111111111',
+            'expiry_year': '2018',
+            'expiry_month': '01',
+            'cvv': '911',
+        }
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            app = self.get_app()
+            self._create_auth_net_gateway_for_site()
+
+            with app.test_client() as c:
+                self._create_guest_order(c, 10)
+
+                sale, = Sale.search([], limit=1)
+                cart, = Cart.search([('sale', '=', sale.id)])
+                sale_date = sale.sale_date
+
+                # The other submission holds the cart and commits first
+                with patch.object(Cart, '_claim_sale', return_value=False):
+                    rv = c.post('/checkout/payment', data=card)
+
+                self.assertEqual(rv.status_code, 302)
+                self.assertTrue('/order/%d' % sale.id in rv.location)
+                sale = Sale(sale.id)
+                self.assertEqual(sale.state, 'draft')
+                self.assertEqual(sale.sale_date, sale_date)
+                self.assertEqual(len(sale.payments), 0)
+
+                # The winning submission goes through the payment
+                rv = c.post('/checkout/payment', data=card)
+                self.assertEqual(rv.status_code, 302)
+                self.assertTrue('/order/%d' % sale.id in rv.location)
+
+                sale = Sale(sale.id)
+                self.assertEqual(sale.state, 'confirmed')
+                self.assertEqual(len(sale.payments), 1)
+                self.assertIsNone(Cart(cart.id).sale)
+
+                # The sale is no longer on the cart to be claimed
+                self.assertFalse(Cart(cart.id)._claim_sale(sale))
+
+                # The claim fails once the other submission commits, which
+                # is a lost claim only if it detached the sale
+                cursor = Transaction().cursor
+                with patch.object(
+                    cursor, 'execute', side_effect=DatabaseOperationalError
+                ), patch.object(
+                    Cart, '_is_sale_detached', return_value=True
+                ) as is_sale_detached:
+                    self.assertFalse(Cart(cart.id)._claim_sale(sale))
+                    is_sale_detached.assert_called_once_with(sale)
+
+                    # Deadlocks or lock timeouts are raised to be retried
+                    is_sale_detached.return_value = False
+                    self.assertRaises(
+                        DatabaseOperationalError,
+                        Cart(cart.id)._claim_sale, sale
+                    )
+
+                # A late re-submission finds an empty cart
+                rv = c.post('/checkout/payment', data=card)
+                self.assertEqual(rv.status_code, 302)
+                self.assertEqual(len(Sale(sale.id).payments), 1)
+
     def test_0330_registered_user_payment_using_payment_profile(self):
         """
         ===================================
@@ -1467,6 +2544,35 @@ class TestCheckoutPayment(BaseTestCheckout):
                 self.assertEqual(rv.status_code, 302)
                 self.assertTrue('/payment' in rv.location)
 
+    def test_0400_credit_card_form_expiry_year_rollover(self):
+        """
+        Ensure that the expiry year choices are cached and refreshed when
+        the year rolls over.
+        """
+        from trytond.modules.nereid_checkout import checkout
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_request_context('/checkout/payment'):
+                with patch.object(checkout, 'datetime') as mock_datetime:
+                    mock_datetime.utcnow.return_value = datetime(2015, 12, 31)
+                    form1 = checkout.CreditCardForm()
+                    form2 = checkout.CreditCardForm()
+
+                    self.assertIs(
+                        form1.expiry_year.choices, form2.expiry_year.choices
+                    )
+                    self.assertEqual(form1.expiry_year.choices[0], (2015, 2015))
+                    self.assertEqual(form1.year_range, (2015, 2040))
+
+                    mock_datetime.utcnow.return_value = datetime(2016, 1, 1)
+                    form3 = checkout.CreditCardForm()
+
+                    self.assertEqual(form3.expiry_year.choices[0], (2016, 2016))
+                    self.assertEqual(form3.year_range, (2016, 2041))
+
 
 def suite():
     "Checkout test suite"